@@ -0,0 +1,380 @@
+from numba import njit, prange, get_num_threads, set_num_threads
+from tqdm.auto import tqdm
+from typing import NamedTuple
+import numpy as np
+import math
+
+from bundling_config import BundlingConfig, FASTMATH, CACHE
+from compatibility import compute_compatible_list, BundlingCancelled
+
+## Struct-of-arrays version of the edge_bundling engine.
+## edges:  (E, 4) float array, rows are [source.x, source.y, target.x, target.y]
+## points: (E, P+2, 2) float array, subdivision points including source and target
+
+# Force iteration mode
+#   "gauss-seidel": edges are moved one after another in place (single core, same order as edge_bundling)
+#   "jacobi":       all edges read the previous positions and write a second buffer, edges run in parallel.
+#                   Every edge is computed by one thread with a fixed summation order, so the result
+#                   does not depend on the thread count or scheduling.
+ITERATION_MODE = "jacobi"
+THREADS = None  # None -> all cores numba sees
+
+# A cycle stops once the mean point displacement over the last two iterations is below TOLERANCE
+# times the mean displacement of the first iteration of the cycle. Single iterations are no measure,
+# the points settle into a back and forth between two positions that keeps them moving.
+# 0 runs every iteration. Opt-in: on airlines 0.1 saves 13 of 139 iterations, all in the first cycle,
+# but moves points by up to 1.7 from the full run and saves no measurable wall time.
+TOLERANCE = 0
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def create_edge_subdivision(edges, P=1):
+    E = edges.shape[0]
+    subdivision_points_for_edges = np.empty((E, P + 2, 2), dtype=np.float64)
+
+    for edge_idx in range(E):
+        sx, sy, tx, ty = edges[edge_idx, 0], edges[edge_idx, 1], edges[edge_idx, 2], edges[edge_idx, 3]
+        subdivision_points_for_edges[edge_idx, 0, 0] = sx
+        subdivision_points_for_edges[edge_idx, 0, 1] = sy
+
+        x = sx
+        y = sy
+        for i in range(P):
+            x -= (sx - tx) / (P + 1)
+            y -= (sy - ty) / (P + 1)
+            subdivision_points_for_edges[edge_idx, i + 1, 0] = x
+            subdivision_points_for_edges[edge_idx, i + 1, 1] = y
+
+        subdivision_points_for_edges[edge_idx, P + 1, 0] = tx
+        subdivision_points_for_edges[edge_idx, P + 1, 1] = ty
+
+    return subdivision_points_for_edges
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _resample_edge(points, edge_idx, out, P):
+    ## Equal arc-length resampling of one polyline into out[edge_idx] (P inner points)
+    n_old = points.shape[1]
+
+    divided_edge_length = 0.0
+    for i in range(1, n_old):
+        divided_edge_length += math.sqrt(math.pow(points[edge_idx, i, 0] - points[edge_idx, i - 1, 0], 2) +
+                                         math.pow(points[edge_idx, i, 1] - points[edge_idx, i - 1, 1], 2))
+
+    segment_length = divided_edge_length / (P + 1)
+    current_segment_length = segment_length
+
+    out[edge_idx, 0, 0] = points[edge_idx, 0, 0]  # source
+    out[edge_idx, 0, 1] = points[edge_idx, 0, 1]
+    new_idx = 1
+    for i in range(1, n_old):
+        prev_x = points[edge_idx, i - 1, 0]
+        prev_y = points[edge_idx, i - 1, 1]
+        cur_x = points[edge_idx, i, 0]
+        cur_y = points[edge_idx, i, 1]
+        old_segment_length = math.sqrt(math.pow(cur_x - prev_x, 2) + math.pow(cur_y - prev_y, 2))
+
+        while old_segment_length > current_segment_length:
+            percent_position = current_segment_length / old_segment_length
+            if new_idx <= P:
+                out[edge_idx, new_idx, 0] = prev_x + percent_position * (cur_x - prev_x)
+                out[edge_idx, new_idx, 1] = prev_y + percent_position * (cur_y - prev_y)
+            new_idx += 1
+
+            old_segment_length -= current_segment_length
+            current_segment_length = segment_length
+
+        current_segment_length -= old_segment_length
+
+    ## Rounding can leave the last point out, place it on the target
+    while new_idx <= P:
+        out[edge_idx, new_idx, 0] = points[edge_idx, n_old - 1, 0]
+        out[edge_idx, new_idx, 1] = points[edge_idx, n_old - 1, 1]
+        new_idx += 1
+
+    out[edge_idx, P + 1, 0] = points[edge_idx, n_old - 1, 0]  # target
+    out[edge_idx, P + 1, 1] = points[edge_idx, n_old - 1, 1]
+
+
+@njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=CACHE)
+def resample_edges(subdivision_points_for_edge, new_subdivision_points):
+    ## Resamples every polyline into new_subdivision_points (E, P_new+2, 2), edges in parallel
+    P = new_subdivision_points.shape[1] - 2
+    for edge_idx in prange(subdivision_points_for_edge.shape[0]):
+        _resample_edge(subdivision_points_for_edge, np.int64(edge_idx), new_subdivision_points, P)
+
+
+def update_edge_divisions(edges, subdivision_points_for_edge, P):
+    new_subdivision_points = np.empty((edges.shape[0], P + 2, 2), dtype=np.float64)
+    resample_edges(subdivision_points_for_edge, new_subdivision_points)
+    return new_subdivision_points
+
+
+def point_buffer(E, config):
+    ## Flat buffer large enough for the subdivision points of every cycle
+    P = P_max = config.P_initial
+    for _cycle in range(config.C):
+        P = round(P * config.P_rate)
+        P_max = max(P_max, P)
+    return np.empty(E * (P_max + 2) * 2, dtype=np.float64)
+
+
+def points_view(buffer, E, n_points):
+    ## Contiguous (E, n_points, 2) array on the start of a point_buffer
+    return buffer[:E * n_points * 2].reshape(E, n_points, 2)
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def calculate_edge_forces(edges, points, indptr, row_end, indices, scores, edge_idx, K, P, S, eps, forces):
+    ## Writes the movement of the P inner points of edge_idx into forces[:P]
+    ## Edges without partners stay straight, their spring forces are zero up to rounding, which
+    ## grows on short edges (e.g. below BundlingConfig.min_length) with their large spring constants
+    if indptr[edge_idx] == row_end[edge_idx]:
+        forces[:P] = 0.0
+        return
+
+    kP = K / (math.sqrt(math.pow(edges[edge_idx, 2] - edges[edge_idx, 0], 2) +
+                        math.pow(edges[edge_idx, 3] - edges[edge_idx, 1], 2)) * (P + 1))
+
+    for i in range(1, P + 1):
+        current_x = points[edge_idx, i, 0]
+        current_y = points[edge_idx, i, 1]
+
+        ##Spring force
+        spring_x = kP * ((points[edge_idx, i - 1, 0] - current_x) + (points[edge_idx, i + 1, 0] - current_x))
+        spring_y = kP * ((points[edge_idx, i - 1, 1] - current_y) + (points[edge_idx, i + 1, 1] - current_y))
+
+        ##Electrostatic force
+        sum_of_forces_x = 0.0
+        sum_of_forces_y = 0.0
+        for oe in range(indptr[edge_idx], row_end[edge_idx]):
+            other = indices[oe]
+            score = scores[oe]
+
+            force_x = points[other, i, 0] - current_x
+            force_y = points[other, i, 1] - current_y
+
+            if (math.fabs(force_x) > eps) or (math.fabs(force_y) > eps):
+                divisor = math.sqrt(force_x * force_x + force_y * force_y)
+                diff = (score / divisor)
+
+                sum_of_forces_x += score * force_x * diff
+                sum_of_forces_y += score * force_y * diff
+
+        forces[i - 1, 0] = S * (spring_x + sum_of_forces_x)
+        forces[i - 1, 1] = S * (spring_y + sum_of_forces_y)
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _record_moves(points, forces, previous, P, moves, edge_idx):
+    ## moves[edge_idx] = (largest, summed) displacement of the inner points of the edge and their summed
+    ## displacement over the last two iterations, previous holds the points of the iteration before
+    largest = 0.0
+    total = 0.0
+    net = 0.0
+    for i in range(P):
+        move = math.sqrt(forces[i, 0] * forces[i, 0] + forces[i, 1] * forces[i, 1])
+        largest = max(largest, move)
+        total += move
+        net_x = points[edge_idx, i + 1, 0] + forces[i, 0] - previous[edge_idx, i + 1, 0]
+        net_y = points[edge_idx, i + 1, 1] + forces[i, 1] - previous[edge_idx, i + 1, 1]
+        net += math.sqrt(net_x * net_x + net_y * net_y)
+    moves[edge_idx, 0] = largest
+    moves[edge_idx, 1] = total
+    moves[edge_idx, 2] = net
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def gauss_seidel_iteration(edges, points, previous, indptr, row_end, indices, scores, K, P, S, eps, moves):
+    ## One sweep over all edges, moving points in place edge by edge.
+    ## previous holds the points of the iteration before and gets the points of this one
+    forces = np.empty((P, 2), dtype=np.float64)
+    for edge_idx in range(edges.shape[0]):
+        calculate_edge_forces(edges, points, indptr, row_end, indices, scores, edge_idx, K, P, S, eps, forces)
+        _record_moves(points, forces, previous, P, moves, edge_idx)
+
+        for i in range(P):
+            previous[edge_idx, i + 1, 0] = points[edge_idx, i + 1, 0]
+            previous[edge_idx, i + 1, 1] = points[edge_idx, i + 1, 1]
+            points[edge_idx, i + 1, 0] += forces[i, 0]
+            points[edge_idx, i + 1, 1] += forces[i, 1]
+
+
+@njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=CACHE)
+def jacobi_iteration(edges, points, new_points, indptr, row_end, indices, scores, K, P, S, eps, moves, forces):
+    ## One sweep over all edges in parallel. Reads points, writes new_points, which holds
+    ## the points of the iteration before until then. forces is (E, P, 2) scratch space
+    for edge_idx in prange(edges.shape[0]):
+        edge_idx = np.int64(edge_idx)
+        edge_forces = forces[edge_idx]
+        calculate_edge_forces(edges, points, indptr, row_end, indices, scores, edge_idx, K, P, S, eps, edge_forces)
+        _record_moves(points, edge_forces, new_points, P, moves, edge_idx)
+
+        for i in range(1, P + 1):
+            new_points[edge_idx, i, 0] = points[edge_idx, i, 0] + edge_forces[i - 1, 0]
+            new_points[edge_idx, i, 1] = points[edge_idx, i, 1] + edge_forces[i - 1, 1]
+
+        new_points[edge_idx, 0] = points[edge_idx, 0]
+        new_points[edge_idx, P + 1] = points[edge_idx, P + 1]
+
+
+def iteration_counts(config=None):
+    ## Iterations run in each cycle
+    config = BundlingConfig() if config is None else config
+    counts = []
+    I = config.I_initial
+    for _cycle in range(config.C):
+        counts.append(math.ceil(I))
+        I *= config.I_rate
+    return counts
+
+
+class BundlingStep(NamedTuple):
+    cycle: int          # cycle the points belong to, -1 for the starting points when there are no cycles
+    iteration: int      # iterations done in that cycle
+    cycle_done: bool    # True once the cycle finished, points are then resampled for the next cycle
+    points: np.ndarray  # copy of the subdivision points
+    max_move: float     # largest point displacement of the last iteration
+    mean_move: float    # mean point displacement of the last iteration
+
+
+def forcebundle_steps(edges, mode=None, threads=None, compatibility=None, progress=None, cancel=None, every=None,
+                      tolerance=None, config=None, weights=None):
+    ## Generator version of forcebundle, yields a BundlingStep after every cycle and,
+    ## with every=N, after every N iterations. The last step holds the forcebundle result.
+    ## progress:  called as progress(done, total) after every iteration
+    ## cancel:    threading.Event, bundling stops with BundlingCancelled once it is set
+    ## tolerance: a cycle ends early once the points settle, see TOLERANCE
+    ## config:    BundlingConfig, the bundling_config defaults when None
+    ## weights:   (E,) electrostatic weight of every edge, e.g. the multiplicity of merged routes (see route_merging)
+    mode = ITERATION_MODE if mode is None else mode
+    threads = THREADS if threads is None else threads
+    tolerance = TOLERANCE if tolerance is None else tolerance
+    config = BundlingConfig() if config is None else config
+    K, eps = config.K, config.eps
+    if mode not in ("gauss-seidel", "jacobi"):
+        raise ValueError("Unknown iteration mode: {}".format(mode))
+
+    old_threads = get_num_threads()
+    if threads is not None:
+        set_num_threads(threads)
+
+    try:
+        ##Set cycle parameters to initials
+        S = config.S_initial
+        I = config.I_initial
+        P = config.P_initial
+
+        ##Create starting points
+        if compatibility is None:
+            print("Compute compatibilities:")
+            compatibility = compute_compatible_list(edges, cancel=cancel, config=config)
+        indptr, row_end, indices, scores = compatibility.arrays()
+        if weights is not None:
+            ##A partner pulls with score^2, so a partner of weight w pulls like w partners with score * sqrt(w)
+            scores = scores * np.sqrt(np.asarray(weights, dtype=np.float64))[indices]
+        E = edges.shape[0]
+        ##Two point buffers sized for the last cycle, reused by the iterations and the resampling,
+        ##and one for the forces of the jacobi iterations
+        buffer, spare = point_buffer(E, config), point_buffer(E, config)
+        scratch = point_buffer(E, config) if mode == "jacobi" else None
+        subdivision_points_for_edge = points_view(buffer, E, P + 2)
+        subdivision_points_for_edge[...] = create_edge_subdivision(edges, P)
+
+        total = sum(iteration_counts(config))
+        done = 0
+        saved = 0
+        moves = np.zeros((edges.shape[0], 3), dtype=np.float64)
+        max_move = mean_move = 0.0
+
+        print("Starting force-bundling cycles:")
+        for cycle in tqdm(range(config.C), unit='cycle'):
+
+            ##Second buffer for the double-buffered update, the previous points in gauss-seidel mode
+            new_points = points_view(spare, E, subdivision_points_for_edge.shape[1])
+            forces = points_view(scratch, E, P) if mode == "jacobi" else None
+
+            iterations = math.ceil(I)
+            for iteration in range(iterations):
+                if mode == "jacobi":
+                    jacobi_iteration(edges, subdivision_points_for_edge, new_points, indptr, row_end, indices, scores,
+                                     K, P, S, eps, moves, forces)
+                    subdivision_points_for_edge, new_points = new_points, subdivision_points_for_edge
+                    buffer, spare = spare, buffer
+                else:
+                    gauss_seidel_iteration(edges, subdivision_points_for_edge, new_points, indptr, row_end, indices,
+                                           scores, K, P, S, eps, moves)
+
+                max_move = moves[:, 0].max() if edges.shape[0] else 0.0
+                mean_move = moves[:, 1].sum() / max(edges.shape[0] * P, 1)
+                if iteration == 0:
+                    first_move = mean_move
+                    converged = False
+                else:
+                    ##From the second iteration on the kernels measure the displacement since two iterations back
+                    net_move = moves[:, 2].sum() / max(edges.shape[0] * P, 1)
+                    converged = net_move < tolerance * first_move
+
+                ##Skipped iterations count as done
+                done += iterations - iteration if converged else 1
+                if progress is not None:
+                    progress(done, total)
+                if cancel is not None and cancel.is_set():
+                    raise BundlingCancelled()
+
+                if converged:
+                    saved += iterations - iteration - 1
+                    iterations = iteration + 1
+                    break
+                if every and (iteration + 1) % every == 0 and iteration + 1 < iterations:
+                    yield BundlingStep(cycle, iteration + 1, False, subdivision_points_for_edge.copy(),
+                                       max_move, mean_move)
+
+            ##Increment S,I,P
+            S *= config.S_rate
+            I *= config.I_rate
+            P = round(P * config.P_rate)
+
+            new_points = points_view(spare, E, P + 2)
+            resample_edges(subdivision_points_for_edge, new_points)
+            subdivision_points_for_edge = new_points
+            buffer, spare = spare, buffer
+            yield BundlingStep(cycle, iterations, True, subdivision_points_for_edge.copy(), max_move, mean_move)
+
+        if config.C == 0:
+            ##No cycles, the straight starting subdivision is the result
+            yield BundlingStep(-1, 0, True, subdivision_points_for_edge.copy(), max_move, mean_move)
+
+        if saved:
+            print("Converged early, saved {} of {} iterations".format(saved, total))
+    finally:
+        set_num_threads(old_threads)
+
+
+def forcebundle(edges, mode=None, threads=None, compatibility=None, progress=None, cancel=None, tolerance=None,
+                config=None, weights=None):
+    ## progress:  called as progress(done, total) after every iteration
+    ## cancel:    threading.Event, bundling stops with BundlingCancelled once it is set
+    ## tolerance: a cycle ends early once the points settle, see TOLERANCE
+    ## config:    BundlingConfig, the bundling_config defaults when None
+    ## weights:   (E,) electrostatic weight of every edge, None for 1
+    for step in forcebundle_steps(edges, mode, threads, compatibility, progress, cancel, tolerance=tolerance,
+                                  config=config, weights=weights):
+        subdivision_points_for_edge = step.points
+
+    return subdivision_points_for_edge
+
+
+def convert_edges(graph):
+    if hasattr(graph, 'edge_index'):
+        ##graph.graph keeps the coordinates as arrays, no need for the pyGraph objects
+        return graph.xy[graph.edge_index].reshape(-1, 4)
+
+    edges = graph.edges()
+    endpoints = np.empty((len(edges), 4), dtype=np.float64)
+    for edge_idx, edge in enumerate(edges):
+        source = edge.node1
+        target = edge.node2
+        endpoints[edge_idx] = (float(source['x']), float(source['y']), float(target['x']), float(target['y']))
+
+    return endpoints
@@ -0,0 +1,91 @@
+## Startup benchmark of the viewer.
+## Launches main.py's window in fresh interpreters and reports
+##   import:         seconds until the application modules are imported
+##   first window:   seconds until the main window is shown with the straight edges
+##   first cycle:    seconds until the first bundling cycle is drawn
+##   first bundle:   seconds until the finished bundling is drawn
+## all measured from interpreter start. The bundling result cache is bypassed, so every run
+## computes the compatibilities and the bundling, only the compiled numba kernels are reused.
+##
+##   python benchmark_startup.py [runs] [--cold]
+##
+## --cold deletes the numba kernel cache before the first run, later runs then show the warm start.
+## Run from the repository directory (main.py loads airlines.graphml by a relative path).
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def clear_kernel_cache():
+    for path in glob.glob(os.path.join(HERE, "__pycache__", "*.nb[ic]")):
+        os.remove(path)
+
+
+def child():
+    ## Launch time of the process, set by the parent
+    start = float(os.environ["BENCHMARK_START"])
+    now = time.time
+    times = {}
+
+    import main
+    import bundling_cache
+    from PySide6.QtWidgets import QApplication
+    times["import"] = now() - start
+
+    ## Empty result cache, removed again when the run ends
+    with tempfile.TemporaryDirectory(prefix="bundling-benchmark-") as cache_dir:
+        bundling_cache.CACHE_DIR = cache_dir
+        app = QApplication(sys.argv)
+
+        ## Record the first drawn cycle and the result as they reach the GUI thread
+        finished = main.MainWindow.bundlingFinished
+        step = main.MainWindow.bundlingStep
+
+        def bundlingStep(self, points):
+            times.setdefault("first cycle", now() - start)
+            step(self, points)
+
+        def bundlingFinished(self, points):
+            finished(self, points)
+            times["first bundle"] = now() - start
+            app.quit()
+
+        main.MainWindow.bundlingStep = bundlingStep
+        main.MainWindow.bundlingFinished = bundlingFinished
+
+        window = main.MainWindow()
+        app.processEvents()
+        times["first window"] = now() - start
+
+        app.exec()
+        window.worker.wait()
+    print(json.dumps(times))
+
+
+def run(runs=3, cold=False):
+    if cold:
+        clear_kernel_cache()
+
+    columns = ("import", "first window", "first cycle", "first bundle")
+    print("run  " + "".join("{:>14}".format(column) for column in columns))
+    for run_idx in range(runs):
+        env = dict(os.environ, BENCHMARK_START=repr(time.time()))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], cwd=HERE, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout
+        times = json.loads(output.strip().splitlines()[-1])
+        print("{:<5}".format(run_idx) + "".join("{:>13.2f}s".format(times.get(column, float('nan')))
+                                                for column in columns))
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child()
+    else:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        run(int(args[0]) if args else 3, "--cold" in sys.argv)
@@ -0,0 +1,171 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from bundling_config import BundlingConfig
+from compatibility import CompatibilityMatrix, compute_compatible_list, COMPATIBILITY_FLOOR
+import compatibility as compatibility_settings
+import array_bundling
+import route_merging
+
+## On-disk cache of bundling results.
+## Every entry is a directory of .npy files named by a hash of the input edges and the
+## parameters the result depends on, so a changed graph or parameter never hits an old entry.
+## Entries are loaded memory-mapped and evicted least recently used first.
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bundling_cache")
+CACHE_SIZE = 2 * 1024 ** 3  # bytes kept on disk before evicting
+CACHE_VERSION = 4  # bump when the stored layout or the algorithms change
+
+
+def edges_hash(edges, *params):
+    edges = np.ascontiguousarray(edges, dtype=np.float64)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((CACHE_VERSION, edges.shape) + params).encode())
+    h.update(edges.tobytes())
+    return h.hexdigest()
+
+
+def _entry_path(kind, key, cache_dir):
+    return os.path.join(cache_dir, "{}-{}".format(kind, key))
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def load_entry(kind, key, names, cache_dir=None):
+    ## Returns the memory-mapped arrays of an entry, None on a miss
+    path = _entry_path(kind, key, cache_dir or CACHE_DIR)
+    if not os.path.isdir(path):
+        return None
+    try:
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in names]
+    except (OSError, ValueError):
+        ## Broken entry, drop it and recompute
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+    ## Mark as recently used. Another process may have evicted the entry meanwhile, a miss then
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return arrays
+
+
+def store_entry(kind, key, arrays, cache_dir=None):
+    ## arrays: dict of name -> array. Written to a temporary directory first so
+    ## a crash never leaves a half written entry behind
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _entry_path(kind, key, cache_dir)
+
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+    except OSError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        ## Another process stored the same entry in between, keep that one
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+    evict(cache_dir)
+
+
+def evict(cache_dir=None, max_size=None):
+    ## Remove least recently used entries until the cache fits in max_size bytes.
+    ## The most recently used entry is always kept
+    cache_dir = cache_dir or CACHE_DIR
+    max_size = CACHE_SIZE if max_size is None else max_size
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith(".tmp-"):
+            try:
+                entries.append((os.path.getmtime(path), _entry_size(path), path))
+            except FileNotFoundError:
+                ## Evicted by another process (e.g. a sweep worker) while scanning
+                continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries)[:-1]:
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def compatibility_caps():
+    ## Current MAX_PARTNERS and MEMORY_BUDGET, part of the keys
+    return compatibility_settings.MAX_PARTNERS, compatibility_settings.MEMORY_BUDGET
+
+
+def cached_compatible_list(edges, cache_dir=None, progress=None, cancel=None, config=None):
+    ## compute_compatible_list, loaded from the cache when the edges and parameters are unchanged.
+    ## The entry holds every pair down to COMPATIBILITY_FLOOR, so a different compatibility_threshold
+    ## above the floor is a view of the same entry and needs no recomputation
+    config = BundlingConfig() if config is None else config
+    floor = min(COMPATIBILITY_FLOOR, config.compatibility_threshold)
+    key = edges_hash(edges, floor, config.eps, config.min_length, *compatibility_caps())
+    names = ("indptr", "indices", "scores")
+
+    arrays = load_entry("compatibility", key, names, cache_dir)
+    if arrays is None:
+        compatibility = compute_compatible_list(edges, progress=progress, cancel=cancel, config=config, floor=floor)
+        arrays = (compatibility.indptr, compatibility.indices, compatibility.scores)
+        store_entry("compatibility", key, dict(zip(names, arrays)), cache_dir)
+
+    return CompatibilityMatrix(*arrays).above(config.compatibility_threshold)
+
+
+def cached_forcebundle(edges, mode=None, threads=None, cache_dir=None, progress=None, cancel=None, on_step=None,
+                       every=None, tolerance=None, config=None, merge=None):
+    ## forcebundle, loaded from the cache when the edges and every bundling parameter are unchanged.
+    ## A hit returns the subdivision points as a read-only memory map (no copy).
+    ## The thread count is not part of the key, both modes give the same result for any count.
+    ## progress is called as progress(stage, done, total) with stage "compatibility" or "bundling".
+    ## on_step gets the intermediate BundlingSteps of a bundling run (see forcebundle_steps), not the final one.
+    ## merge bundles every route once (see route_merging), the points are still one polyline per edge
+    mode = array_bundling.ITERATION_MODE if mode is None else mode
+    tolerance = array_bundling.TOLERANCE if tolerance is None else tolerance
+    config = BundlingConfig() if config is None else config
+    merge = route_merging.MERGE_ROUTES if merge is None else merge
+    key = edges_hash(edges, *config, *compatibility_caps(), mode, tolerance, merge)
+
+    arrays = load_entry("bundling", key, ("points",), cache_dir)
+    if arrays is not None:
+        return arrays[0]
+
+    if merge:
+        merged = route_merging.merge_routes(edges)
+        bundle_edges, weights = merged.edges, merged.weights
+        expand = lambda points: route_merging.expand_points(points, merged)
+    else:
+        bundle_edges, weights = edges, None
+        expand = lambda points: points
+
+    stage_progress = lambda stage: None if progress is None else (lambda done, total: progress(stage, done, total))
+    compatibility = cached_compatible_list(bundle_edges, cache_dir, stage_progress("compatibility"), cancel, config)
+    for step in array_bundling.forcebundle_steps(bundle_edges, mode=mode, threads=threads,
+                                                 compatibility=compatibility, progress=stage_progress("bundling"),
+                                                 cancel=cancel, every=every, tolerance=tolerance, config=config,
+                                                 weights=weights):
+        if on_step is not None and not (step.cycle_done and step.cycle == config.C - 1):
+            on_step(step._replace(points=expand(step.points)))
+        points = step.points
+
+    points = expand(points)
+
+    store_entry("bundling", key, {"points": points}, cache_dir)
+    return points
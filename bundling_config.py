@@ -0,0 +1,43 @@
+from typing import NamedTuple
+
+## Bundling parameters, kept apart from edge_bundling so the array engine can be imported
+## without building the jitclass types of the Point/Edge engine
+
+K = 10 # Bundling constant. Affects string force. Dont put too (?) large
+
+C = 6   #Amount of cycles 
+## initials
+I_initial = 50  #Amount of iterations
+P_initial = 1   #Subdivision amount
+S_initial = 0.4 #Point move 
+
+## Changing rates
+P_rate = 1.75 #2      #With P_rate = 1.75 it will go [1,2,4,7,12,21]
+I_rate = 0.6666667
+S_rate = 0.5
+
+compatibility_threshold = 0.2
+eps = 1e-6
+min_length = 0.0  # Edges shorter than this get no compatible partners and stay straight. 0 bundles every edge
+
+# Numba Jit Execution settings
+FASTMATH = True
+# Compiled kernels are cached in __pycache__ and reused by later runs. numba checks the source
+# file of a kernel only, clear the cache (*.nbi, *.nbc) after changing FASTMATH
+CACHE = True
+
+
+class BundlingConfig(NamedTuple):
+    ## Parameters of one bundling run, passed to forcebundle and compute_compatible_list.
+    ## Defaults are the module values above, e.g. BundlingConfig(K=5, S_initial=0.2)
+    K: float = K
+    C: int = C
+    I_initial: float = I_initial
+    P_initial: int = P_initial
+    S_initial: float = S_initial
+    P_rate: float = P_rate
+    I_rate: float = I_rate
+    S_rate: float = S_rate
+    compatibility_threshold: float = compatibility_threshold
+    eps: float = eps
+    min_length: float = min_length
@@ -0,0 +1,627 @@
+from numba import njit, prange, get_num_threads
+from tqdm.auto import tqdm
+import numpy as np
+import math
+
+from bundling_config import BundlingConfig, compatibility_threshold, eps, FASTMATH, CACHE
+
+# Rows/columns per tile of the compatibility matrix
+TILE_SIZE = 128
+# Lowest threshold the cached compatibilities are computed with, higher thresholds are views
+# of the same matrix (see CompatibilityMatrix.above)
+COMPATIBILITY_FLOOR = 0.1
+# Caps on the stored pairs, the highest scores are kept (None -> no cap)
+#   MAX_PARTNERS:  compatible edges kept per edge
+#   MEMORY_BUDGET: bytes of the stored matrix, PAIR_BYTES per pair (both directions, index and score)
+MAX_PARTNERS = None
+MEMORY_BUDGET = None
+PAIR_BYTES = 2 * (8 + 8)
+# "grid": only score pairs whose midpoints are close enough to reach the threshold (spatial index)
+# "tiles": score every pair
+COMPATIBILITY_METHOD = "grid"
+
+## Compatibility measures working on an (E, 4) endpoint array.
+## Row layout: [source.x, source.y, target.x, target.y]
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def edge_length(edges, i):
+    return math.sqrt(math.pow(edges[i, 2] - edges[i, 0], 2) + math.pow(edges[i, 3] - edges[i, 1], 2))
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def point_projection(x, y, edges, i):
+    sx, sy, tx, ty = edges[i, 0], edges[i, 1], edges[i, 2], edges[i, 3]
+    L = math.sqrt(math.pow(tx - sx, 2) + math.pow(ty - sy, 2))
+    r = ((sy - y) * (sy - ty) - (sx - x) * (tx - sx)) / math.pow(L, 2)
+    return sx + r * (tx - sx), sy + r * (ty - sy)
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def edge_visibility(edges, i, j, eps):
+    # Visibility of edge j seen from edge i
+    I0_x, I0_y = point_projection(edges[j, 0], edges[j, 1], edges, i)
+    I1_x, I1_y = point_projection(edges[j, 2], edges[j, 3], edges, i)
+
+    dist = math.sqrt(math.pow(I0_x - I1_x, 2) + math.pow(I0_y - I1_y, 2))
+    dist = dist if dist >= eps else eps
+
+    midI_x = (I0_x + I1_x) / 2.0
+    midI_y = (I0_y + I1_y) / 2.0
+
+    midP_x = (edges[i, 0] + edges[i, 2]) / 2.0
+    midP_y = (edges[i, 1] + edges[i, 3]) / 2.0
+
+    mid_dist = math.sqrt(math.pow(midP_x - midI_x, 2) + math.pow(midP_y - midI_y, 2))
+    return max(0.0, 1 - 2 * mid_dist / dist)
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def compatiblity_score(edges, i, j, eps):
+    edge_dist = edge_length(edges, i)
+    oedge_dist = edge_length(edges, j)
+
+    P_x = edges[i, 2] - edges[i, 0]
+    P_y = edges[i, 3] - edges[i, 1]
+    Q_x = edges[j, 2] - edges[j, 0]
+    Q_y = edges[j, 3] - edges[j, 1]
+
+    dot_prod = P_x * Q_x + P_y * Q_y
+    angles_score = math.fabs(dot_prod / (edge_dist * oedge_dist))
+
+    lavg = (edge_dist + oedge_dist) / 2.0
+    scales_score = 2.0 / (lavg / min(edge_dist, oedge_dist) + max(edge_dist, oedge_dist) / lavg)
+
+    midP_x = (edges[i, 0] + edges[i, 2]) / 2.0
+    midP_y = (edges[i, 1] + edges[i, 3]) / 2.0
+    midQ_x = (edges[j, 0] + edges[j, 2]) / 2.0
+    midQ_y = (edges[j, 1] + edges[j, 3]) / 2.0
+
+    positi_score = lavg / (lavg + math.sqrt(math.pow(midP_x - midQ_x, 2) + math.pow(midP_y - midQ_y, 2)))
+
+    visivi_score = min(edge_visibility(edges, i, j, eps), edge_visibility(edges, j, i, eps))
+
+    return angles_score * scales_score * positi_score * visivi_score
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def staged_compatibility_score(edges, i, j, eps, threshold):
+    ## compatiblity_score, 0 as soon as the pair can no longer reach threshold.
+    ## Every term is <= 1, so the product of the terms computed so far bounds the score.
+    ## Cheapest terms first: angle, scale, position, then the two visibilities
+    edge_dist = edge_length(edges, i)
+    oedge_dist = edge_length(edges, j)
+
+    P_x = edges[i, 2] - edges[i, 0]
+    P_y = edges[i, 3] - edges[i, 1]
+    Q_x = edges[j, 2] - edges[j, 0]
+    Q_y = edges[j, 3] - edges[j, 1]
+
+    dot_prod = P_x * Q_x + P_y * Q_y
+    angles_score = math.fabs(dot_prod / (edge_dist * oedge_dist))
+    if angles_score < threshold:
+        return 0.0
+
+    lavg = (edge_dist + oedge_dist) / 2.0
+    scales_score = 2.0 / (lavg / min(edge_dist, oedge_dist) + max(edge_dist, oedge_dist) / lavg)
+    if angles_score * scales_score < threshold:
+        return 0.0
+
+    midP_x = (edges[i, 0] + edges[i, 2]) / 2.0
+    midP_y = (edges[i, 1] + edges[i, 3]) / 2.0
+    midQ_x = (edges[j, 0] + edges[j, 2]) / 2.0
+    midQ_y = (edges[j, 1] + edges[j, 3]) / 2.0
+
+    positi_score = lavg / (lavg + math.sqrt(math.pow(midP_x - midQ_x, 2) + math.pow(midP_y - midQ_y, 2)))
+    bound = angles_score * scales_score * positi_score
+    if bound < threshold:
+        return 0.0
+
+    visibility = edge_visibility(edges, i, j, eps)
+    if bound * visibility < threshold:
+        return 0.0
+    visivi_score = min(visibility, edge_visibility(edges, j, i, eps))
+
+    return angles_score * scales_score * positi_score * visivi_score
+
+
+@njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _score_block(edges, row_start, row_end, col_start, col_end, tile, eps, threshold, block):
+    ## block[r, c] = score of pair (row_start + r, col_start + c), -1 where the pair is not in the upper triangle.
+    ## Pairs below threshold may get 0 instead of their score
+    n_tiles = (col_end - col_start + tile - 1) // tile
+    for t in prange(n_tiles):
+        tile_start = col_start + t * tile
+        tile_end = min(tile_start + tile, col_end)
+        for i in range(row_start, row_end):
+            for j in range(tile_start, tile_end):
+                if j > i:
+                    block[i - row_start, j - col_start] = staged_compatibility_score(edges, i, j, eps, threshold)
+                else:
+                    block[i - row_start, j - col_start] = -1.0
+
+
+class BundlingCancelled(Exception):
+    pass
+
+
+class CompatibilityMatrix:
+    ## Compatible edges in CSR layout: the neighbours of edge i are
+    ## indices[indptr[i]:row_end[i]] with the scores at the same positions, highest score first.
+    ## The arrays hold every pair above the floor threshold the matrix was computed with,
+    ## above(threshold) gives the matrix for a higher threshold by moving row_end only
+    def __init__(self, indptr, indices, scores, row_end=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.row_end = indptr[1:] if row_end is None else row_end
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+    @property
+    def nnz(self):
+        return int((self.row_end - self.indptr[:-1]).sum())
+
+    def arrays(self):
+        ## Arguments of the force kernels
+        return self.indptr, self.row_end, self.indices, self.scores
+
+    def neighbours(self, edge_id):
+        start, end = self.indptr[edge_id], self.row_end[edge_id]
+        return self.indices[start:end], self.scores[start:end]
+
+    def above(self, threshold):
+        ## Pairs with score >= threshold, sharing the arrays of this matrix (no copy)
+        return CompatibilityMatrix(self.indptr, self.indices, self.scores,
+                                   _row_ends(self.indptr, self.row_end, self.scores, threshold))
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices, scores=self.scores, row_end=self.row_end)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["indptr"], data["indices"], data["scores"],
+                       data["row_end"] if "row_end" in data else None)
+
+    @classmethod
+    def from_pairs(cls, n_edges, rows, cols, values):
+        ## Both directions of every (i < j) pair, neighbours of an edge by decreasing score
+        all_rows = np.concatenate((rows, cols))
+        all_cols = np.concatenate((cols, rows))
+        all_values = np.concatenate((values, values))
+        order = np.lexsort((all_cols, -all_values, all_rows))
+
+        indptr = np.zeros(n_edges + 1, dtype=np.int64)
+        np.cumsum(np.bincount(all_rows, minlength=n_edges), out=indptr[1:])
+
+        return cls(indptr, all_cols[order].astype(np.int64), all_values[order].astype(np.float64))
+
+
+@njit(nogil=True, cache=CACHE)
+def _row_ends(indptr, row_end, scores, threshold):
+    ## End of the scores >= threshold prefix of every row (binary search, rows are sorted decreasing)
+    E = row_end.shape[0]
+    new_end = np.empty(E, dtype=np.int64)
+    for edge_idx in range(E):
+        lo, hi = indptr[edge_idx], row_end[edge_idx]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if scores[mid] >= threshold:
+                lo = mid + 1
+            else:
+                hi = mid
+        new_end[edge_idx] = lo
+    return new_end
+
+
+def compatible_pair_blocks(edges, threshold=None, tile=None, progress=None, cancel=None, eps=eps):
+    ## Upper triangle of the compatibility matrix, computed in tile x tile tiles in parallel.
+    ## Only one block of tiles (tile x width scores) lives in memory at a time.
+    ## Yields the pairs (i < j) with score >= threshold of every block as three arrays
+    threshold = compatibility_threshold if threshold is None else threshold
+    tile = TILE_SIZE if tile is None else tile
+    E = edges.shape[0]
+    ## Enough column tiles per block to keep every core busy
+    width = tile * get_num_threads() * 4
+    block = np.empty((tile, width), dtype=np.float64)
+
+    with tqdm(total=E, unit='Edges') as bar:
+        for row_start in range(0, E, tile):
+            row_end = min(row_start + tile, E)
+            for col_start in range(row_start, E, width):
+                col_end = min(col_start + width, E)
+                _score_block(edges, row_start, row_end, col_start, col_end, tile, eps, threshold, block)
+
+                view = block[:row_end - row_start, :col_end - col_start]
+                r, c = np.nonzero(view >= threshold)
+                yield (r + row_start).astype(np.int64), (c + col_start).astype(np.int64), view[r, c]
+            bar.update(row_end - row_start)
+            if progress is not None:
+                progress(row_end, E)
+            if cancel is not None and cancel.is_set():
+                raise BundlingCancelled()
+
+
+def _concatenate_pairs(blocks):
+    rows, cols, values = [], [], []
+    for r, c, v in blocks:
+        rows.append(r)
+        cols.append(c)
+        values.append(v)
+
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+def compatible_pairs(edges, threshold=None, tile=None, progress=None, cancel=None, eps=eps):
+    ## All blocks of compatible_pair_blocks as three arrays
+    return _concatenate_pairs(compatible_pair_blocks(edges, threshold, tile, progress, cancel, eps))
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _scale_score(a, b):
+    lavg = (a + b) / 2.0
+    return 2.0 / (lavg / min(a, b) + max(a, b) / lavg)
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _build_grid(edges, threshold):
+    ## Edges are bucketed by length (powers of two), each bucket gets a uniform grid over
+    ## the edge midpoints. The cell size of a bucket is the largest midpoint distance at
+    ## which an edge of that bucket can still reach the threshold with a shorter edge:
+    ##   score <= scales_score * positi_score <= lavg / (lavg + dist(midP, midQ))
+    ##   -> dist(midP, midQ) <= lavg * (1 / threshold - 1) <= longest * (1 / threshold - 1)
+    E = edges.shape[0]
+    lengths = np.empty(E, dtype=np.float64)
+    mid = np.empty((E, 2), dtype=np.float64)
+    for i in range(E):
+        lengths[i] = edge_length(edges, i)
+        mid[i, 0] = (edges[i, 0] + edges[i, 2]) / 2.0
+        mid[i, 1] = (edges[i, 1] + edges[i, 3]) / 2.0
+
+    ## Zero length edges never get a finite score
+    valid = (lengths > 0) & np.isfinite(lengths)
+    bucket = np.full(E, -1, dtype=np.int64)
+    if not valid.any():
+        return lengths, mid, bucket, np.zeros(0), np.zeros(0), np.zeros(0, np.int64), np.zeros(0, np.int64), \
+            np.zeros(0, np.int64), np.zeros(1, np.int64), np.zeros(0), np.zeros(2), np.zeros((0, 5))
+
+    min_length = lengths[valid].min()
+    for i in range(E):
+        if valid[i]:
+            bucket[i] = max(0, int(math.floor(math.log2(lengths[i] / min_length))))
+    n_buckets = bucket.max() + 1
+
+    lo = np.full(n_buckets, np.inf)
+    hi = np.zeros(n_buckets)
+    for i in range(E):
+        if valid[i]:
+            lo[bucket[i]] = min(lo[bucket[i]], lengths[i])
+            hi[bucket[i]] = max(hi[bucket[i]], lengths[i])
+
+    origin = np.empty(2)
+    origin[0] = mid[valid, 0].min()
+    origin[1] = mid[valid, 1].min()
+    extent_x = mid[valid, 0].max() - origin[0]
+    extent_y = mid[valid, 1].max() - origin[1]
+
+    ## At most 2**20 cells per axis, larger cells only give more candidates
+    cell = np.maximum(hi * (1.0 / threshold - 1.0), max(extent_x, extent_y, 1e-12) / 2 ** 20)
+    nx = np.empty(n_buckets, dtype=np.int64)
+    for b in range(n_buckets):
+        nx[b] = int(extent_x / cell[b]) + 3
+
+    keys = np.zeros(E, dtype=np.int64)
+    for i in range(E):
+        if valid[i]:
+            b = bucket[i]
+            cx = int((mid[i, 0] - origin[0]) / cell[b]) + 1
+            cy = int((mid[i, 1] - origin[1]) / cell[b]) + 1
+            keys[i] = cy * nx[b] + cx
+
+    ## Sorted by (bucket, cell), each bucket is a contiguous slice
+    order = np.argsort(bucket * (keys.max() + 1) + keys, kind='mergesort')
+    order = order[bucket[order] >= 0]
+    bucket_ptr = np.zeros(n_buckets + 1, dtype=np.int64)
+    for i in order:
+        bucket_ptr[bucket[i] + 1] += 1
+    bucket_ptr = np.cumsum(bucket_ptr)
+
+    ## What the candidate bound needs of an edge, in grid order so a cell is read contiguously:
+    ## midpoint, length, direction
+    sorted_terms = np.empty((order.shape[0], 5), dtype=np.float64)
+    for k in range(order.shape[0]):
+        j = order[k]
+        sorted_terms[k, 0] = mid[j, 0]
+        sorted_terms[k, 1] = mid[j, 1]
+        sorted_terms[k, 2] = lengths[j]
+        sorted_terms[k, 3] = edges[j, 2] - edges[j, 0]
+        sorted_terms[k, 4] = edges[j, 3] - edges[j, 1]
+
+    return lengths, mid, bucket, lo, hi, nx, order, keys[order], bucket_ptr, cell, origin, sorted_terms
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _visit_candidates(i, edges, threshold, lengths, mid, bucket, lo, hi, nx, order, sorted_keys, bucket_ptr,
+                      cell, origin, sorted_terms, out):
+    ## Candidates of edge i among edges of the same or longer buckets (j > i within the own bucket).
+    ## Writes them into out when given, returns how many there are
+    count = 0
+    a = lengths[i]
+    d_x = edges[i, 2] - edges[i, 0]
+    d_y = edges[i, 3] - edges[i, 1]
+    for b in range(bucket[i], lo.shape[0]):
+        if bucket_ptr[b] == bucket_ptr[b + 1]:
+            continue
+        ## Longer buckets only lower the scale score
+        if lo[b] > a and _scale_score(a, lo[b]) < threshold:
+            break
+
+        start, end = bucket_ptr[b], bucket_ptr[b + 1]
+        keys = sorted_keys[start:end]
+        cx = int((mid[i, 0] - origin[0]) / cell[b]) + 1
+        cy = int((mid[i, 1] - origin[1]) / cell[b]) + 1
+        for y in range(cy - 1, cy + 2):
+            for x in range(cx - 1, cx + 2):
+                if x < 0 or y < 0:
+                    continue
+                key = y * nx[b] + x
+                first = np.searchsorted(keys, key)
+                for k in range(start + first, end):
+                    if sorted_keys[k] != key:
+                        break
+                    j = order[k]
+                    if b == bucket[i] and j <= i:
+                        continue
+
+                    ## Upper bound of the score from the cheap terms (scale, position, angle),
+                    ## see staged_compatibility_score
+                    length = sorted_terms[k, 2]
+                    lavg = (a + length) / 2.0
+                    dist = math.sqrt(math.pow(mid[i, 0] - sorted_terms[k, 0], 2) +
+                                     math.pow(mid[i, 1] - sorted_terms[k, 1], 2))
+                    bound = _scale_score(a, length) * lavg / (lavg + dist)
+                    if bound < threshold:
+                        continue
+                    dot_prod = d_x * sorted_terms[k, 3] + d_y * sorted_terms[k, 4]
+                    if bound * math.fabs(dot_prod / (a * length)) < threshold:
+                        continue
+
+                    if out.shape[0] > 0:
+                        out[count] = j
+                    count += 1
+    return count
+
+
+@njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _grid_block(edges, row_start, row_end, threshold, eps, lengths, mid, bucket, lo, hi, nx, order, sorted_keys,
+                bucket_ptr, cell, origin, sorted_terms):
+    ## Scores the candidate pairs of rows [row_start, row_end)
+    n_rows = row_end - row_start
+    empty = np.empty(0, dtype=np.int64)
+    counts = np.zeros(n_rows + 1, dtype=np.int64)
+    for r in prange(n_rows):
+        i = row_start + r
+        if bucket[i] >= 0:
+            counts[r + 1] = _visit_candidates(i, edges, threshold, lengths, mid, bucket, lo, hi, nx, order,
+                                              sorted_keys, bucket_ptr, cell, origin, sorted_terms, empty)
+    indptr = np.cumsum(counts)
+
+    rows = np.empty(indptr[-1], dtype=np.int64)
+    cols = np.empty(indptr[-1], dtype=np.int64)
+    values = np.empty(indptr[-1], dtype=np.float64)
+    for r in prange(n_rows):
+        i = row_start + r
+        if indptr[r + 1] > indptr[r]:
+            _visit_candidates(i, edges, threshold, lengths, mid, bucket, lo, hi, nx, order, sorted_keys,
+                              bucket_ptr, cell, origin, sorted_terms, cols[indptr[r]:indptr[r + 1]])
+            for k in range(indptr[r], indptr[r + 1]):
+                rows[k] = i
+                values[k] = staged_compatibility_score(edges, i, cols[k], eps, threshold)
+
+    keep = values >= threshold
+    return rows[keep], cols[keep], values[keep]
+
+
+def compatible_pair_blocks_grid(edges, threshold=None, tile=None, progress=None, cancel=None, eps=eps):
+    ## Same pairs as compatible_pair_blocks, but only pairs that can reach the threshold get scored.
+    ## Rows are processed in blocks so only one block of candidates lives in memory.
+    threshold = compatibility_threshold if threshold is None else threshold
+    tile = TILE_SIZE if tile is None else tile
+    if threshold <= 0:
+        yield from compatible_pair_blocks(edges, threshold, tile, progress, cancel, eps)
+        return
+
+    E = edges.shape[0]
+    lengths, mid, bucket, lo, hi, nx, order, sorted_keys, bucket_ptr, cell, origin, sorted_terms = \
+        _build_grid(edges, threshold)
+    block_rows = tile * get_num_threads() * 4
+
+    with tqdm(total=E, unit='Edges') as bar:
+        for row_start in range(0, E, block_rows):
+            row_end = min(row_start + block_rows, E)
+            r, c, v = _grid_block(edges, row_start, row_end, threshold, eps, lengths, mid, bucket, lo, hi, nx,
+                                  order, sorted_keys, bucket_ptr, cell, origin, sorted_terms)
+            ## Keep the upper triangle convention (i < j)
+            yield np.minimum(r, c), np.maximum(r, c), v
+            bar.update(row_end - row_start)
+            if progress is not None:
+                progress(row_end, E)
+            if cancel is not None and cancel.is_set():
+                raise BundlingCancelled()
+
+
+def compatible_pairs_grid(edges, threshold=None, tile=None, progress=None, cancel=None, eps=eps):
+    ## All blocks of compatible_pair_blocks_grid as three arrays
+    return _concatenate_pairs(compatible_pair_blocks_grid(edges, threshold, tile, progress, cancel, eps))
+
+
+@njit(nogil=True, cache=CACHE)
+def _heap_less(values, items, x, y):
+    ## Heap order: lower value first, the higher item first on ties, so that the heap keeps
+    ## the highest values and among equal values the lowest items, whatever the arrival order
+    return values[x] < values[y] or (values[x] == values[y] and items[x] > items[y])
+
+
+@njit(nogil=True, cache=CACHE)
+def _sift_down(values, items, size, pos):
+    ## Min-heap on values, items are moved along
+    while True:
+        smallest = pos
+        left = 2 * pos + 1
+        right = left + 1
+        if left < size and _heap_less(values, items, left, smallest):
+            smallest = left
+        if right < size and _heap_less(values, items, right, smallest):
+            smallest = right
+        if smallest == pos:
+            return
+        values[pos], values[smallest] = values[smallest], values[pos]
+        items[pos], items[smallest] = items[smallest], items[pos]
+        pos = smallest
+
+
+@njit(nogil=True, cache=CACHE)
+def _heap_push(values, items, size, value, item):
+    ## Push into a bounded min-heap of capacity values.shape[0], returns the new size.
+    ## A full heap replaces its smallest entry when the new one comes later in heap order
+    if size < values.shape[0]:
+        pos = size
+        values[pos], items[pos] = value, item
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if not _heap_less(values, items, pos, parent):
+                break
+            values[parent], values[pos] = values[pos], values[parent]
+            items[parent], items[pos] = items[pos], items[parent]
+            pos = parent
+        return size + 1
+
+    if value > values[0] or (value == values[0] and item < items[0]):
+        values[0], items[0] = value, item
+        _sift_down(values, items, size, 0)
+    return size
+
+
+@njit(nogil=True, cache=CACHE)
+def _push_top_k(rows, cols, values, heap_scores, heap_indices, heap_size):
+    ## Every pair goes into the heaps of both of its edges
+    for k in range(rows.shape[0]):
+        i, j = rows[k], cols[k]
+        heap_size[i] = _heap_push(heap_scores[i], heap_indices[i], heap_size[i], values[k], j)
+        heap_size[j] = _heap_push(heap_scores[j], heap_indices[j], heap_size[j], values[k], i)
+
+
+@njit(nogil=True, cache=CACHE)
+def _push_budget(rows, cols, values, n_edges, heap_scores, heap_pairs, size):
+    ## Pairs are stored as row * n_edges + col
+    for k in range(rows.shape[0]):
+        size = _heap_push(heap_scores, heap_pairs, size, values[k], rows[k] * n_edges + cols[k])
+    return size
+
+
+@njit(nogil=True, cache=CACHE)
+def _top_k_rows(heap_scores, heap_indices, heap_size):
+    ## CSR arrays of the heaps, every row by decreasing score (ties by neighbour)
+    E = heap_size.shape[0]
+    indptr = np.zeros(E + 1, dtype=np.int64)
+    for edge_idx in range(E):
+        indptr[edge_idx + 1] = indptr[edge_idx] + heap_size[edge_idx]
+
+    indices = np.empty(indptr[E], dtype=np.int64)
+    scores = np.empty(indptr[E], dtype=np.float64)
+    for edge_idx in range(E):
+        size = heap_size[edge_idx]
+        order = np.argsort(heap_indices[edge_idx, :size], kind='mergesort')
+        order = order[np.argsort(-heap_scores[edge_idx, :size][order], kind='mergesort')]
+        for k in range(size):
+            indices[indptr[edge_idx] + k] = heap_indices[edge_idx, order[k]]
+            scores[indptr[edge_idx] + k] = heap_scores[edge_idx, order[k]]
+    return indptr, indices, scores
+
+
+def top_k_compatibility(n_edges, blocks, k):
+    ## The k highest scoring partners of every edge, kept in one bounded heap per edge while
+    ## the blocks come in. Rows are not symmetric any more, edge i may keep j but not the reverse.
+    ## Returns (CompatibilityMatrix, number of dropped neighbour entries)
+    heap_scores = np.empty((n_edges, k), dtype=np.float64)
+    heap_indices = np.empty((n_edges, k), dtype=np.int64)
+    heap_size = np.zeros(n_edges, dtype=np.int64)
+
+    entries = 0
+    for rows, cols, values in blocks:
+        _push_top_k(rows, cols, values, heap_scores, heap_indices, heap_size)
+        entries += 2 * rows.shape[0]
+
+    compatibility = CompatibilityMatrix(*_top_k_rows(heap_scores, heap_indices, heap_size))
+    return compatibility, entries - compatibility.nnz
+
+
+def budget_compatibility(n_edges, blocks, max_pairs):
+    ## The max_pairs highest scoring pairs overall, kept in one bounded heap while the blocks come in.
+    ## Returns (CompatibilityMatrix, number of dropped pairs)
+    heap_scores = np.empty(max_pairs, dtype=np.float64)
+    heap_pairs = np.empty(max_pairs, dtype=np.int64)
+    size = 0
+
+    pairs = 0
+    for rows, cols, values in blocks:
+        size = _push_budget(rows, cols, values, n_edges, heap_scores, heap_pairs, size)
+        pairs += rows.shape[0]
+
+    compatibility = CompatibilityMatrix.from_pairs(n_edges, heap_pairs[:size] // n_edges, heap_pairs[:size] % n_edges,
+                                                   heap_scores[:size])
+    return compatibility, pairs - size
+
+
+def compute_compatible_list(edges, method=None, progress=None, cancel=None, config=None, floor=None,
+                            max_partners=None, memory_budget=None):
+    ## Same neighbours and scores as edge_bundling.compute_compatible_list,
+    ## computed on the endpoint array and stored as a CompatibilityMatrix.
+    ## progress(done, total) is called per block of edges, setting the cancel event
+    ## stops the computation with BundlingCancelled.
+    ## config: BundlingConfig, only compatibility_threshold, eps and min_length are used.
+    ##         Edges shorter than min_length are not scored and get no partners
+    ## floor:  keep every pair down to this score in the arrays (see CompatibilityMatrix.above),
+    ##         None -> only the pairs above compatibility_threshold
+    ## max_partners, memory_budget: see MAX_PARTNERS and MEMORY_BUDGET
+    method = COMPATIBILITY_METHOD if method is None else method
+    config = BundlingConfig() if config is None else config
+    max_partners = MAX_PARTNERS if max_partners is None else max_partners
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    threshold = config.compatibility_threshold
+    floor = threshold if floor is None else min(floor, threshold)
+
+    E = edges.shape[0]
+    scored = None
+    if config.min_length > 0:
+        lengths = np.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1])
+        scored = np.flatnonzero(lengths >= config.min_length)
+        print("Skipping {} edges shorter than {}".format(E - scored.shape[0], config.min_length))
+
+    scored_edges = edges if scored is None else edges[scored]
+    if method == "grid":
+        blocks = compatible_pair_blocks_grid(scored_edges, floor, progress=progress, cancel=cancel, eps=config.eps)
+    elif method == "tiles":
+        blocks = compatible_pair_blocks(scored_edges, floor, progress=progress, cancel=cancel, eps=config.eps)
+    else:
+        raise ValueError("Unknown compatibility method: {}".format(method))
+    if scored is not None:
+        ##Back to the ids of all edges
+        blocks = ((scored[rows], scored[cols], values) for rows, cols, values in blocks)
+
+    if max_partners:
+        compatibility, dropped = top_k_compatibility(E, blocks, max_partners)
+        print("Kept the {} best partners per edge, dropped {} of {} neighbour entries".format(
+            max_partners, dropped, compatibility.nnz + dropped))
+    elif memory_budget:
+        compatibility, dropped = budget_compatibility(E, blocks, max(1, memory_budget // PAIR_BYTES))
+        print("Kept {} pairs within {} bytes, dropped {} of {} pairs".format(
+            compatibility.nnz // 2, memory_budget, dropped, compatibility.nnz // 2 + dropped))
+    else:
+        compatibility = CompatibilityMatrix.from_pairs(E, *_concatenate_pairs(blocks))
+
+    return compatibility.above(threshold) if floor < threshold else compatibility
@@ -6,26 +6,8 @@ from tqdm.auto import tqdm
 import math
 
 # Parameters
-
-
-K = 10 # Bundling constant. Affects string force. Dont put too (?) large
-
-C = 6   #Amount of cycles 
-## initials
-I_initial = 50  #Amount of iterations
-P_initial = 1   #Subdivision amount
-S_initial = 0.4 #Point move 
-
-## Changing rates
-P_rate = 1.75 #2      #With P_rate = 1.75 it will go [1,2,4,7,12,21]
-I_rate = 0.6666667
-S_rate = 0.5
-
-compatibility_threshold = 0.2
-eps = 1e-6
-
-# Numba Jit Execution settings
-FASTMATH = True
+from bundling_config import K, C, I_initial, P_initial, S_initial, P_rate, I_rate, S_rate, \
+    compatibility_threshold, eps, FASTMATH
 
 @jitclass([('x', float32), ('y', float32)])
 class Point:
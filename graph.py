@@ -1,38 +1,201 @@
 from pygraphml import GraphMLParser 
 from pygraphml import Graph as pyGraph
+from pygraphml import Node, Edge
+from collections.abc import Mapping
 import numpy as np
 import math
 from PySide6.QtCore import Qt, QSize, QLineF,QRectF
 
+from graphml_loader import load_graphml, load_snapshot, save_snapshot, file_signature
+
+SNAPSHOT = True  # keep a binary snapshot <file>.snapshot next to parsed GraphML files (see graphml_loader)
+MAPPED = False   # parse keeps the graph arrays in the memory-mapped snapshot files (out-of-core graphs).
+                 # Only once the snapshot exists: the first parse of a file still loads it into memory
+
+
+def _csr(ends, counts):
+    ## Edge ids grouped by their end node, stable so every group is in ascending order
+    indptr = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, np.argsort(ends, kind='stable')
+
+
+class EdgeIdsByNode(Mapping):
+    ## Read-only node id (str) -> edge ids (list of str) view on the CSR arrays, the dicts
+    ## node_id_to_out_id and node_id_to_in_id used to be. Nodes without edges are missing as before.
+    ## Kept for older callers, graph.out_edge_ids and in_edge_ids need no string conversions
+    def __init__(self, indptr, edges, node_index):
+        self.indptr = indptr
+        self.edges = edges
+        self.node_index = node_index
+    
+    def __getitem__(self, node_id):
+        n = self.node_index[str(node_id)]
+        start, end = self.indptr[n], self.indptr[n + 1]
+        if start == end:
+            raise KeyError(node_id)
+        return [str(edge_id) for edge_id in self.edges[start:end]]
+    
+    def __iter__(self):
+        return (node_id for node_id, n in self.node_index.items() if self.indptr[n + 1] > self.indptr[n])
+    
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
 
 class graph(pyGraph):
     def __init__(self,g=None):
+        ##Arrays of the streaming loader (see graphml_loader), None for graphs built from pyGraph objects
+        self.arrays = None
+        self.labels = None
+        self._node_objects = None
+        self._edge_objects = None
+        self._name_to_node = None
         super(graph,self).__init__()
         
+        self.name_to_node = {}        
+        self.node_id_to_out_id = {}
+        self.node_id_to_in_id = {}
+        
         if isinstance(g, pyGraph):
             self._nodes = g._nodes
             self._edges = g._edges
+            self.build_geometry()
             self.get_node_labels()
             self.outgoing, self.incoming = self.airport_throughput()
             self.total = self.outgoing + self.incoming
-        
-        self.name_to_node = {}        
-        self.node_id_to_out_id = {}
-        self.node_id_to_in_id = {}
     
-    def parse(self,url):
-        g = GraphMLParser().parse(url)
-        self._nodes = g._nodes
-        self._edges = g._edges
-        self.get_node_labels()
-        self.outgoing, self.incoming = self.airport_throughput()
+    def parse(self,url,mapped=None):
+        ## mapped: keep coordinates, edge ends, attributes, labels, degrees and adjacency in the
+        ##         snapshot files as numpy.memmap instead of memory (see MAPPED)
+        mapped = MAPPED if mapped is None else mapped
+        keep_snapshot = SNAPSHOT or mapped
+        snapshot = load_snapshot(url, mmap=mapped) if keep_snapshot else None
+        if snapshot is None:
+            ##No valid snapshot yet, also in mapped mode the file is parsed and indexed in memory once
+            ##(load_graphml, airport_throughput) and written out, the graph has to fit for that
+            signature = file_signature(url) if keep_snapshot else None
+            self._set_arrays(load_graphml(url))
+            self.get_node_labels()
+            self.outgoing, self.incoming = self.airport_throughput()
+            if keep_snapshot:
+                derived = dict(labels=self.labels, outgoing=self.outgoing, incoming=self.incoming,
+                               out_indptr=self.out_indptr, out_edges=self.out_edges, in_indptr=self.in_indptr,
+                               in_edges=self.in_edges)
+                try:
+                    save_snapshot(url, self.arrays, derived, signature)
+                except OSError as error:
+                    if mapped:
+                        raise
+                    print("Could not write the graph snapshot: {}".format(error))
+            if mapped:
+                ##Reopen from the files, the parsed arrays are dropped
+                snapshot = load_snapshot(url, mmap=True)
+        
+        if snapshot is not None:
+            arrays, derived = snapshot
+            self._set_arrays(arrays)
+            self.labels = derived['labels']
+            self.outgoing, self.incoming = derived['outgoing'], derived['incoming']
+            self._set_adjacency(derived['out_indptr'], derived['out_edges'], derived['in_indptr'],
+                                derived['in_edges'])
         self.total = self.outgoing + self.incoming
         #self.create_nodes()
         #self.create_edges()
+    
+    def _set_arrays(self, arrays):
+        self.arrays = arrays
+        ##The pyGraph nodes and edges are only built once something asks for them
+        self._node_objects = None
+        self._edge_objects = None
+        self._name_to_node = None
+        self.build_geometry()
+    
+    ##pyGraph keeps its objects in _nodes and _edges, with arrays they are made on first access
+    @property
+    def _nodes(self):
+        if self._node_objects is None:
+            self._build_view()
+        return self._node_objects
+    
+    @_nodes.setter
+    def _nodes(self, nodes):
+        self._node_objects = nodes
+    
+    @property
+    def _edges(self):
+        if self._edge_objects is None:
+            self._build_view()
+        return self._edge_objects
+    
+    @_edges.setter
+    def _edges(self, edges):
+        self._edge_objects = edges
+    
+    @property
+    def name_to_node(self):
+        if self._name_to_node is None:
+            self._name_to_node = dict(zip(self.labels, self.nodes()))
+        return self._name_to_node
+    
+    @name_to_node.setter
+    def name_to_node(self, name_to_node):
+        self._name_to_node = name_to_node
+    
+    def _build_view(self):
+        ## Node and Edge objects as GraphMLParser makes them, plus the label, in and out the
+        ## methods below add. Edge ids are the positions in the file
+        arrays = self.arrays
+        nodes = []
+        for idx, node_id in enumerate(arrays.node_ids):
+            node = Node(str(node_id))
+            node['label'] = ""
+            for key, column in arrays.node_data.items():
+                node[key] = str(column[idx])
+            if self.labels is not None:
+                node['label'] = str(self.labels[idx])
+            if 'in' not in arrays.node_data and hasattr(self, 'incoming'):
+                node['in'] = self.incoming[idx]
+                node['out'] = self.outgoing[idx]
+            nodes.append(node)
+        
+        edges = []
+        for idx in range(arrays.source.shape[0]):
+            edge = Edge(nodes[arrays.source[idx]], nodes[arrays.target[idx]])
+            edge.id = str(idx)
+            for key, column in arrays.edge_data.items():
+                edge[key] = str(column[idx])
+            edges.append(edge)
+        
+        self._node_objects = nodes
+        self._edge_objects = edges
+        
+    def build_geometry(self):
+        ## xy (N, 2) node coordinates and edge_index (E, 2) source and target node positions,
+        ## read these instead of converting the node['x'], node['y'] strings again
+        if self.arrays is not None:
+            self.xy = self.arrays.xy
+            self.edge_index = self.arrays.edge_index
+            return
+        
+        nodes = self.nodes()
+        self.xy = np.array([(float(node['x']), float(node['y'])) for node in nodes], dtype=np.float64).reshape(-1, 2)
+        position = {node.id: idx for idx, node in enumerate(nodes)}
+        self.edge_index = np.array([(position[edge.node1.id], position[edge.node2.id]) for edge in self.edges()],
+                                   dtype=np.int64).reshape(-1, 2)
         
     def get_node_labels(self): 
         ##Extract the airport labels from the tooltip
         
+        if self.arrays is not None:
+            ##Truncating to 3 characters
+            self.labels = self.arrays.node_data['tooltip'].astype('<U3')
+            if self._node_objects is not None:
+                for node, label in zip(self._node_objects, self.labels):
+                    node['label'] = str(label)
+            self._name_to_node = None
+            return str(self.labels[-1])
+        
         for node in self.nodes():
             
             label = node['tooltip'][0:3]
@@ -40,49 +203,57 @@ class graph(pyGraph):
             
             self.name_to_node[label] = node
         
+        self.labels = np.array([node['label'] for node in self.nodes()], dtype=str)
         return label 
     
     
     def airport_throughput(self):
-        ## Count the throughput of an airport
-        outgoing = np.zeros(len(self.nodes()),dtype=np.int32)
-        incoming = np.zeros(len(self.nodes()),dtype=np.int32)
-        
-        for edge in self.edges():
-            outgoing[int(edge.node1.id)] += 1   #Outgoing  
-            incoming[int(edge.node2.id)] += 1   #Incoming
-            
-            ##Set up node to out dict
-            try: 
-                self.node_id_to_in_id[str(edge.node2.id)].append(edge.id)
-            except KeyError:
-                self.node_id_to_in_id[str(edge.node2.id)]  =  [edge.id]
-                
-            try:
-                self.node_id_to_out_id[str(edge.node1.id)].append(edge.id)
-            except KeyError:
-                self.node_id_to_out_id[str(edge.node1.id)] = [edge.id]
+        ## Count the throughput of an airport and index the edges of every node as CSR arrays:
+        ## out_edges[out_indptr[n]:out_indptr[n + 1]] are the ids (positions) of the edges leaving
+        ## the node at position n in ascending order, in_indptr/in_edges those arriving
+        source, target = self.edge_index[:, 0], self.edge_index[:, 1]
+        n_nodes = self.xy.shape[0]
+        outgoing = np.bincount(source, minlength=n_nodes).astype(np.int32)
+        incoming = np.bincount(target, minlength=n_nodes).astype(np.int32)
+        self._set_adjacency(*_csr(source, outgoing), *_csr(target, incoming))
         
         ##Check if size info in node
-        try:
-            self.nodes()[0]["in"] = self.nodes()[0]["in"]
-        except KeyError:
-            for node in self.nodes():
-                node["in"] = incoming[int(node.id)]
-                node["out"] = outgoing[int(node.id)]
+        if self.arrays is not None:
+            nodes = self._node_objects if 'in' not in self.arrays.node_data else None
+        else:
+            nodes = self.nodes() if self.nodes() and 'in' not in self.nodes()[0].attributes() else None
+        for node, n_in, n_out in zip(nodes or [], incoming, outgoing):
+            node["in"] = n_in
+            node["out"] = n_out
 
         return outgoing,incoming
+    
+    def _set_adjacency(self, out_indptr, out_edges, in_indptr, in_edges):
+        self.out_indptr, self.out_edges = out_indptr, out_edges
+        self.in_indptr, self.in_edges = in_indptr, in_edges
+        
+        node_ids = self.arrays.node_ids if self.arrays is not None else [node.id for node in self.nodes()]
+        self.node_index = {str(node_id): idx for idx, node_id in enumerate(node_ids)}
+        self.node_id_to_out_id = EdgeIdsByNode(self.out_indptr, self.out_edges, self.node_index)
+        self.node_id_to_in_id = EdgeIdsByNode(self.in_indptr, self.in_edges, self.node_index)
+    
+    def out_edge_ids(self, n):
+        ## Ids of the edges leaving the node at position n
+        return self.out_edges[self.out_indptr[n]:self.out_indptr[n + 1]]
+    
+    def in_edge_ids(self, n):
+        ## Ids of the edges arriving at the node at position n
+        return self.in_edges[self.in_indptr[n]:self.in_indptr[n + 1]]
         
         
     def create_nodes(self):
         #Create nodes
         
-        for i in self.nodes():
-            x = float(i['x'])
-            y = float(i['y'])
+        for idx, i in enumerate(self.nodes()):
+            x, y = self.xy[idx]
             #c = colours[int(i.id)]
             
-            total = int(i['in']) + int(i['out'])
+            total = self.total[idx]
             d =  2 * math.log (total,2) 
             
             ellipse = QRectF(x -d/2, y-d/2, d, d)
@@ -92,14 +263,9 @@ class graph(pyGraph):
     
     def create_edges(self):
         
-        for edge in self.edges():
-            start = edge.node1
-            x1 = float(start['x'])
-            y1 = float(start['y'])
-            
-            end = edge.node2
-            x2 = float(end['x'])
-            y2 = float(end['y'])
+        for edge, (start, end) in zip(self.edges(), self.edge_index):
+            x1, y1 = self.xy[start]
+            x2, y2 = self.xy[end]
             
             line = QLineF(x1,y1,x2,y2)
             self.line_to_edge[line] = edge
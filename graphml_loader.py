@@ -0,0 +1,218 @@
+from array import array
+from typing import NamedTuple
+import xml.etree.ElementTree as ET
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+## Streaming GraphML loader.
+## Reads nodes and edges one element at a time (iterparse) straight into arrays, so large files
+## never exist as a DOM or as one Python object per node and edge. Node data is kept by key as in
+## pygraphml, node['tooltip'] there is node_data['tooltip'] here. Data values are kept as UTF-8 in one
+## bytes buffer per key (StringColumn), not as Python strings or fixed-width numpy strings.
+##
+## Snapshots: the arrays, plus whatever derived arrays the caller adds, are stored as one .npy file
+## per column in a sidecar directory <file>.snapshot next to the GraphML file. A snapshot is only
+## used while the size, the modification time and the content hash of the GraphML file are the ones
+## it was written for. Loaded with mmap=True the columns stay in their files (numpy.memmap), so
+## graphs larger than memory can be read and only the touched pages are paged in.
+
+SNAPSHOT_VERSION = 3  # bump when the stored arrays change
+
+
+class StringColumn:
+    ## (n,) column of str, value i is the UTF-8 data[offsets[i]:offsets[i + 1]].
+    ## A numpy str array pads every value to the longest one, this takes the bytes of the values
+    def __init__(self, offsets, data):
+        self.offsets = offsets  # (n + 1,) int64
+        self.data = data        # uint8
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        return bytes(self.data[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    def astype(self, dtype):
+        ## numpy array of the values, e.g. astype(np.float64), or astype('<U3') for the first 3 characters
+        return np.fromiter(iter(self), dtype=dtype, count=len(self))
+
+
+class GraphArrays(NamedTuple):
+    node_ids: np.ndarray  # (N,) id attribute of every node, in file order
+    xy: np.ndarray        # (N, 2) float node data 'x' and 'y'
+    node_data: dict       # key -> (N,) StringColumn, every node data key ('' where a node has none)
+    edge_index: np.ndarray  # (E, 2) node index (position in node_ids) of every edge source and target
+    edge_data: dict         # key -> (E,) StringColumn, every edge data key
+
+    @property
+    def x(self):
+        return self.xy[:, 0]
+
+    @property
+    def y(self):
+        return self.xy[:, 1]
+
+    @property
+    def source(self):
+        return self.edge_index[:, 0]
+
+    @property
+    def target(self):
+        return self.edge_index[:, 1]
+
+
+def _local(tag):
+    ## Tag without the {namespace}
+    return tag.rpartition('}')[2]
+
+
+def _append(columns, key, idx, value):
+    ## columns[key][idx] = value, padding the rows of items without that key.
+    ## A column is the bytes of its values and the end offset of every value
+    data, ends = columns.setdefault(key, (bytearray(), array('q')))
+    ends.extend([len(data)] * (idx - len(ends)))
+    data += value.encode('utf-8')
+    ends.append(len(data))
+
+
+def _data_arrays(columns, n):
+    arrays = {}
+    for key, (data, ends) in columns.items():
+        ends.extend([len(data)] * (n - len(ends)))
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.frombuffer(ends, dtype=np.int64)
+        arrays[key] = StringColumn(offsets, np.frombuffer(data, dtype=np.uint8))
+    return arrays
+
+
+def load_graphml(path):
+    node_ids = []
+    index = {}  # node id -> position
+    node_columns = {}
+    source, target = array('q'), array('q')
+    pending = []  # (edge, source id, target id) of edges listed before their nodes
+    edge_columns = {}
+
+    parent = None
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        tag = _local(element.tag)
+        if event == "start":
+            if tag == "graph":
+                parent = element
+            continue
+
+        if tag == "node":
+            idx = len(node_ids)
+            node_ids.append(element.get("id"))
+            index[node_ids[idx]] = idx
+            for data in element:
+                _append(node_columns, data.get("key"), idx, data.text or "")
+        elif tag == "edge":
+            idx = len(source)
+            s, t = element.get("source"), element.get("target")
+            source.append(index.get(s, -1))
+            target.append(index.get(t, -1))
+            if source[idx] < 0 or target[idx] < 0:
+                pending.append((idx, s, t))
+            for data in element:
+                _append(edge_columns, data.get("key"), idx, data.text or "")
+        else:
+            continue
+
+        ## Drop the finished element, the graph element would otherwise keep all of them
+        element.clear()
+        if parent is not None:
+            parent.clear()
+
+    edge_index = np.empty((len(source), 2), dtype=np.int64)
+    edge_index[:, 0] = np.frombuffer(source, dtype=np.int64)
+    edge_index[:, 1] = np.frombuffer(target, dtype=np.int64)
+    del source, target
+    for idx, s, t in pending:
+        for end, node_id in ((0, s), (1, t)):
+            if node_id not in index:
+                raise ValueError('Graph has no node with ID {}'.format(node_id))
+            edge_index[idx, end] = index[node_id]
+
+    node_data = _data_arrays(node_columns, len(node_ids))
+    edge_data = _data_arrays(edge_columns, edge_index.shape[0])
+
+    xy = np.zeros((len(node_ids), 2), dtype=np.float64)
+    for column, key in enumerate(("x", "y")):
+        if key in node_data:
+            xy[:, column] = node_data[key].astype(np.float64)
+    return GraphArrays(np.array(node_ids, dtype=str), xy, node_data, edge_index, edge_data)
+
+
+def snapshot_path(path):
+    return path + ".snapshot"
+
+
+def file_signature(path, stat=None):
+    ## [size, mtime in ns] and the blake2b hash of the content
+    stat = os.stat(path) if stat is None else stat
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64), h.hexdigest()
+
+
+def save_snapshot(path, arrays, derived=None, signature=None):
+    ## derived:   dict of name -> array stored along with the GraphArrays
+    ## signature: file_signature of the file the arrays were read from, taken before reading it
+    stat, digest = file_signature(path) if signature is None else signature
+    columns = {"version": np.array([SNAPSHOT_VERSION]), "stat": stat, "hash": np.array([digest]),
+               "node_ids": arrays.node_ids, "xy": arrays.xy, "edge_index": arrays.edge_index}
+    for kind in ("node", "edge"):
+        for key, column in getattr(arrays, kind + "_data").items():
+            columns[kind + "_offsets." + key] = column.offsets
+            columns[kind + "_strings." + key] = column.data
+    columns.update({"derived." + name: array for name, array in (derived or {}).items()})
+
+    ## Written to a temporary directory first so a crash never leaves a half written snapshot behind
+    target = snapshot_path(path)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+    try:
+        for name, column in columns.items():
+            np.save(os.path.join(tmp, name + ".npy"), column)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.rename(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def load_snapshot(path, mmap=False):
+    ## Returns (GraphArrays, derived dict), None when there is no valid snapshot of the file.
+    ## mmap=True maps the columns read-only instead of reading them
+    directory = snapshot_path(path)
+    load = lambda name: np.load(os.path.join(directory, name + ".npy"), mmap_mode='r' if mmap else None)
+    try:
+        stat = os.stat(path)
+        if load("version")[0] != SNAPSHOT_VERSION:
+            return None
+        ## Size and mtime first, hashing reads the whole file
+        if not np.array_equal(load("stat"), [stat.st_size, stat.st_mtime_ns]):
+            return None
+        if str(load("hash")[0]) != file_signature(path, stat)[1]:
+            return None
+
+        columns = {name[:-len(".npy")]: load(name[:-len(".npy")]) for name in os.listdir(directory)
+                   if name.endswith(".npy")}
+    except (OSError, ValueError):
+        return None
+
+    prefixed = lambda prefix: {name[len(prefix):]: array for name, array in columns.items()
+                               if name.startswith(prefix)}
+    data = lambda kind: {key: StringColumn(offsets, prefixed(kind + "_strings.")[key])
+                         for key, offsets in prefixed(kind + "_offsets.").items()}
+    arrays = GraphArrays(columns["node_ids"], columns["xy"], data("node"), columns["edge_index"], data("edge"))
+    return arrays, prefixed("derived.")
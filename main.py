@@ -9,16 +9,24 @@
 # OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING 
 # OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #from pygraphml import GraphMLParser 
-import sys, random, math
-from PySide6.QtCore import Qt, QSize, QRectF, QLineF
+import sys, random, math, threading
+from PySide6.QtCore import Qt, QSize, QRectF, QLineF, QThread, Signal, QLocale
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 import PySide6.QtWidgets as QtWidgets
 from PySide6.QtWidgets import QApplication, QMainWindow, QGraphicsScene, QGraphicsView, QSizePolicy, QWidget
-from PySide6.QtGui import QBrush, QPen, QTransform, QPainter, QColor, QIntValidator, QSurfaceFormat
+from PySide6.QtGui import QBrush, QPen, QTransform, QPainter, QColor, QIntValidator, QDoubleValidator, QSurfaceFormat
 import numpy as np
+import numba
 import copy
 import graph
-from edge_bundling import *
+from array_bundling import convert_edges
+from bundling_cache import cached_forcebundle
+from compatibility import BundlingCancelled, COMPATIBILITY_FLOOR
+from bundling_config import BundlingConfig
+
+## The bundling worker starts the parallel kernels from a QThread. Prefer OpenMP to TBB,
+## TBB can hang at interpreter exit when it was first used outside the main thread
+numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
 
 class VisGraphicsScene(QGraphicsScene):
     def __init__(self,window):
@@ -154,29 +162,19 @@ class VisGraphicsScene(QGraphicsScene):
                 [item.setVisible(True) for item in self.filtered_items]
                 self.filtered_items = []
         
-        edges = self.window.graph.edges()
+        ##By node and edge position, the graph's Node and Edge objects are not needed
+        graph = self.window.graph
         for node_id in filtered_nodes_id:
-            node = self.window.graph.nodes()[node_id]
-            item = self.window.node_to_circle[node]
+            item = self.window.node_circles[node_id]
             item.setVisible(False)
             self.filtered_items.append(item)
             
-            try:
-                out_edges = self.window.graph.node_id_to_out_id[str(node_id)]
-            except:
-                out_edges = []
-            try:
-                in_edges = self.window.graph.node_id_to_in_id[str(node_id)]
-            except:
-                in_edges = []   
-            
-            node_edges_id = out_edges + in_edges
+            node_edges_id = np.concatenate((graph.out_edge_ids(node_id), graph.in_edge_ids(node_id)))
             
             for e_id in node_edges_id:
                 
                 if not self.bundling_active:
-                    edge = edges[int(e_id)]
-                    item = self.window.edge_to_line[edge]
+                    item = self.straight_lines[e_id]
                     item.setVisible(False)
                     self.filtered_items.append(item)
                 else:
@@ -241,7 +239,7 @@ class VisGraphicsScene(QGraphicsScene):
     def selectEdges(self,node):
         ##Select edges stemming from node
         graph = self.window.graph
-        out = graph.node_id_to_out_id[node.id]
+        out = graph.out_edge_ids(graph.node_index[node.id])
         edges = graph.edges()
         
         for edge_id in out:
@@ -258,7 +256,7 @@ class VisGraphicsScene(QGraphicsScene):
     def selectBundleEdges(self,node):
         ##Select edges stemming from node
         graph = self.window.graph
-        out = graph.node_id_to_out_id[node.id]
+        out = graph.out_edge_ids(graph.node_index[node.id])
         
         for edge_id in out:
             for line in self.window.sub_edge_to_lines[int(edge_id)]:
@@ -301,6 +299,32 @@ class VisGraphicsView(QGraphicsView):
             self.myScene.wasDragg = True
         super().mouseReleaseEvent(event)
 
+
+class BundlingWorker(QThread):
+    ## Runs the force bundling next to the GUI thread, the numba kernels release the GIL
+    progress = Signal(str, int, int)
+    step = Signal(object)
+    result = Signal(object)
+    cancelled = Signal()
+    
+    def __init__(self, edges, config=None, parent=None):
+        super(BundlingWorker, self).__init__(parent)
+        self.edges = edges
+        self.config = config
+        self.cancel_event = threading.Event()
+        
+    def run(self):
+        try:
+            points = cached_forcebundle(self.edges, progress=self.progress.emit, cancel=self.cancel_event,
+                                        on_step=self.step.emit, config=self.config)
+        except BundlingCancelled:
+            self.cancelled.emit()
+            return
+        self.result.emit(points)
+        
+    def cancel(self):
+        self.cancel_event.set()
+        
         
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -319,6 +343,7 @@ class MainWindow(QMainWindow):
         ## Dicts to go from node to graphical object and vice versa
         self.circle_to_node = {}
         self.node_to_circle = {}
+        self.node_circles = [None] * len(self.graph.total)  # by node position
         self.drawNodes()
         
         ## Dicts to go from line to graphical object and vice versa
@@ -328,6 +353,8 @@ class MainWindow(QMainWindow):
         
         self.line_to_sub_edge = {}
         self.sub_edge_to_lines = {}
+        
+        self.bundling_config = BundlingConfig()
                 
         ##
         self.addGUI()
@@ -338,10 +365,95 @@ class MainWindow(QMainWindow):
         #print(self.circle_to_node)
         #print(self.node_to_circle)
         
+        ## Bundle in the background, straight lines can be explored meanwhile
         self.bundle_edges = convert_edges(self.graph)
-        self.subdivision_points_for_edges = forcebundle(self.bundle_edges)
-        self.scene.bundle_lines = self.drawLines(self.subdivision_points_for_edges)
+        self.startBundling()
+        
+    def startBundling(self):
+        self.worker = BundlingWorker(self.bundle_edges, self.bundling_config, self)
+        self.worker.progress.connect(self.bundlingProgress)
+        self.worker.step.connect(self.bundlingStep)
+        self.worker.result.connect(self.bundlingFinished)
+        self.worker.cancelled.connect(self.bundlingCancelled)
+        self.worker.start()
+        
+    def bundlingProgress(self, stage, done, total):
+        bar = self.dock.widget().findChild(QtWidgets.QProgressBar, 'progress')
+        bar.setMaximum(total)
+        bar.setValue(done)
+        bar.setFormat("{} %p%".format(stage.capitalize()))
+        
+    def bundlingStep(self, step):
+        ## Show the bundling of a finished cycle while the next ones run
+        self.updateBundleLines(step.points)
+        self.dock.widget().findChild(QtWidgets.QPushButton, 'toggle').setEnabled(True)
+        
+    def bundlingFinished(self, subdivision_points_for_edges):
+        self.updateBundleLines(subdivision_points_for_edges)
+        
+        widget = self.dock.widget()
+        bar = widget.findChild(QtWidgets.QProgressBar, 'progress')
+        bar.setMaximum(1)
+        bar.setValue(1)
+        bar.setFormat("Bundling done")
+        widget.findChild(QtWidgets.QPushButton, 'cancel').setEnabled(False)
+        widget.findChild(QtWidgets.QPushButton, 'toggle').setEnabled(True)
+        
+    def bundlingCancelled(self):
+        widget = self.dock.widget()
+        widget.findChild(QtWidgets.QProgressBar, 'progress').setFormat("Bundling cancelled")
+        widget.findChild(QtWidgets.QPushButton, 'cancel').setEnabled(False)
+        
+    def updateBundleLines(self, subdivision_points_for_edges):
+        ## Replace the bundled polylines, keeping the filter and the selection
+        scene = self.scene
+        filter_value = scene.old_value
+        scene.filterChangeEvent(0)
+        
+        selected_edges = {self.line_to_sub_edge[item] for item in scene.selection if item in self.line_to_sub_edge}
+        scene.selection = [item for item in scene.selection if item not in self.line_to_sub_edge]
+        
+        for line in scene.bundle_lines:
+            scene.removeItem(line)
+        self.line_to_sub_edge = {}
+        self.sub_edge_to_lines = {}
+        
+        self.subdivision_points_for_edges = subdivision_points_for_edges
+        scene.bundle_lines = self.drawLines(subdivision_points_for_edges)
+        
+        if scene.bundling_active:
+            [line.setVisible(True) for line in scene.bundle_lines]
+        for edge_id in selected_edges:
+            for line in self.sub_edge_to_lines[edge_id]:
+                line.setPen(scene.selected)
+                scene.selection.append(line)
+        
+        if filter_value:
+            scene.filterChangeEvent(str(filter_value))
+        
+    def stopBundling(self):
+        ## Cancel a running bundling without reporting it
+        for signal in (self.worker.progress, self.worker.step, self.worker.result, self.worker.cancelled):
+            signal.disconnect()
+        if self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
+        
+    def thresholdChangeEvent(self, value):
+        ## Rebundle with another compatibility threshold. Thresholds above the floor reuse the
+        ## cached compatibilities, only the force cycles run again
+        if value == "" or float(value) == self.bundling_config.compatibility_threshold:
+            return
+        self.stopBundling()
+        self.bundling_config = self.bundling_config._replace(compatibility_threshold=float(value))
+        self.dock.widget().findChild(QtWidgets.QPushButton, 'cancel').setEnabled(True)
+        self.startBundling()
         
+    def closeEvent(self, event):
+        if self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
         
     def addGUI(self):
         ## Attempt to add gui
@@ -359,10 +471,21 @@ class MainWindow(QMainWindow):
         layout.addWidget(QtWidgets.QLabel("Info:", objectName='InfoTitle'),1)
         layout.addWidget(QtWidgets.QLabel("", objectName='Info'),0)
         
-        button = QtWidgets.QPushButton("Toggle Force Bundling")
+        button = QtWidgets.QPushButton("Toggle Force Bundling", objectName='toggle')
         button.clicked.connect(self.scene.toggleBundlingEvent) 
+        button.setEnabled(False)    #Enabled once the bundling is done
         layout.addWidget(button,3)
         
+        progress = QtWidgets.QProgressBar(objectName='progress')
+        progress.setFormat("Waiting for bundling")
+        layout.addWidget(progress,3)
+        
+        cancel = QtWidgets.QPushButton("Cancel Bundling", objectName='cancel')
+        cancel.clicked.connect(lambda : self.worker.cancel())
+        layout.addWidget(cancel,3)
+        
+        layout.addWidget(self.thresholdSetUp(),3)
+        
         layout.addWidget(QtWidgets.QLabel("", objectName='Space'),2)
     
         layout.addWidget(self.filterSetUp(),2)
@@ -420,6 +543,31 @@ class MainWindow(QMainWindow):
         
         return param_box
     
+    def thresholdSetUp(self):
+        param_box_layout = QtWidgets.QVBoxLayout()
+        param_box = QtWidgets.QGroupBox("Bundling",objectName='bundling') 
+        
+        threshold_label = QtWidgets.QLabel('Compatibility threshold:', objectName='thresholdLabel')
+        input_box = QtWidgets.QLineEdit(str(self.bundling_config.compatibility_threshold), objectName='threshold')
+        
+        send_text = lambda  : self.thresholdChangeEvent(input_box.text())
+        input_box.editingFinished.connect(send_text)
+        
+        ## Down to the floor the cached compatibilities are reused.
+        ## C locale, the system one may accept a decimal comma that float() rejects
+        onlyFloat = QDoubleValidator(COMPATIBILITY_FLOOR, 1.0, 3)
+        onlyFloat.setNotation(QDoubleValidator.StandardNotation)
+        locale = QLocale.c()
+        locale.setNumberOptions(QLocale.RejectGroupSeparator)
+        onlyFloat.setLocale(locale)
+        input_box.setValidator(onlyFloat)
+        
+        param_box_layout.addWidget(threshold_label)
+        param_box_layout.addWidget(input_box,1)
+        param_box.setLayout(param_box_layout)
+        
+        return param_box
+    
     def createGraphicView(self):    
         self.scene = VisGraphicsScene(self)
         """
@@ -461,34 +609,34 @@ class MainWindow(QMainWindow):
         #colours[total > 100] = 4
         nodes = g.nodes()
         
+        xy = g.xy.tolist()
+        labels = g.labels.tolist()
         for index in reversed(sort_indexes):
             i = nodes[index]
-            x = float(i['x'])
-            y = float(i['y'])
-            c = colours[int(i.id)]
+            x, y = xy[index]
+            c = colours[index]
         
-            d = math.sqrt(total[int(i.id)]) 
+            d = math.sqrt(total[index]) 
             
             ellipse = self.scene.addEllipse(x-d/2, y-d/2, d, d, self.scene.cir_pen,self.brush[c])
-            ellipse.setData(0,i['label'])
+            ellipse.setData(0,labels[index])
             
             self.circle_to_node[ellipse] = i
             self.node_to_circle[i] = ellipse
+            self.node_circles[index] = ellipse
     
     def drawEdges(self,edges):
+        ## edges: the graph's edges, in order
         straight_lines = list()
+        xy = self.graph.xy.tolist()
+        labels = self.graph.labels.tolist()
         
-        for edge in edges:
-            start = edge.node1
-            x1 = float(start['x'])
-            y1 = float(start['y'])
-            
-            end = edge.node2
-            x2 = float(end['x'])
-            y2 = float(end['y'])
+        for edge, (start, end) in zip(edges, self.graph.edge_index.tolist()):
+            x1, y1 = xy[start]
+            x2, y2 = xy[end]
             
             line = self.scene.addLine(x1,y1,x2,y2,pen=self.scene.line_pen)
-            line.setData(0,"{} -> {}".format(start['label'],end['label']))
+            line.setData(0,"{} -> {}".format(labels[start],labels[end]))
             
             self.line_to_edge[line] = edge
             self.edge_to_line[edge] = line
@@ -498,20 +646,17 @@ class MainWindow(QMainWindow):
             
     def drawLines(self,bundled_edges):
         bundle_lines = list()
+        labels = self.graph.labels.tolist()
+        edge_index = self.graph.edge_index.tolist()
         
         for edge_id, bundle_edge in enumerate(bundled_edges):
-            real_edge = self.graph.edges()[edge_id]
+            start, end = edge_index[edge_id]
             for i in range(1,len(bundle_edge)):
-                start = bundle_edge[i-1]
-                x1 = start.x
-                y1 = start.y
-                
-                end = bundle_edge[i]
-                x2 = end.x
-                y2 = end.y
+                x1, y1 = bundle_edge[i-1]
+                x2, y2 = bundle_edge[i]
                 
                 line = self.scene.addLine(x1,y1,x2,y2,pen=self.scene.line_pen)
-                line.setData(0,"{}->{}".format(real_edge.node1['label'],real_edge.node2['label']))
+                line.setData(0,"{}->{}".format(labels[start],labels[end]))
             
                 #line.setData(0,"")
                 line.setVisible(False)
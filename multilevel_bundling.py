@@ -0,0 +1,165 @@
+from numba import njit, prange, get_num_threads, set_num_threads
+import numpy as np
+import math
+
+from bundling_config import BundlingConfig, FASTMATH, CACHE
+from compatibility import compute_compatible_list, BundlingCancelled
+import array_bundling
+
+## Multilevel force bundling: coarsen - bundle - refine.
+## Groups of highly compatible edges are merged into one super-edge (their aligned mean), repeatedly,
+## until few edges are left. Only that coarse set runs the full bundling cycles. The result is then
+## projected back level by level, every member edge follows the polyline of its super-edge bent onto
+## its own endpoints, and a few iterations with the compatibilities of the level smooth out the details.
+
+COARSEN_THRESHOLD = 0.6   # edges with at least this compatibility score to a group seed join its group
+COARSE_EDGES = 500        # stop coarsening once this few edges are left
+MIN_REDUCTION = 0.8       # stop coarsening once a level keeps more than this fraction of the edges
+REFINE_ITERATIONS = 10    # iterations run on every finer level after projecting
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _group_edges(edges, indptr, row_end, indices, scores, threshold):
+    ## Greedy grouping, longest edges first. Every ungrouped edge seeds a group and takes its
+    ## ungrouped partners scoring >= threshold.
+    ## Returns group (E,) group id of every edge, flipped (E,) True where the edge runs against its seed
+    E = edges.shape[0]
+    lengths = np.empty(E, dtype=np.float64)
+    for i in range(E):
+        lengths[i] = math.sqrt(math.pow(edges[i, 2] - edges[i, 0], 2) + math.pow(edges[i, 3] - edges[i, 1], 2))
+
+    group = np.full(E, -1, dtype=np.int64)
+    flipped = np.zeros(E, dtype=np.bool_)
+    n_groups = 0
+    for seed in np.argsort(-lengths):
+        if group[seed] >= 0:
+            continue
+        group[seed] = n_groups
+        for oe in range(indptr[seed], row_end[seed]):
+            other = indices[oe]
+            if group[other] < 0 and scores[oe] >= threshold:
+                group[other] = n_groups
+                ## Compatibility ignores direction, align the partner with the seed
+                dot_prod = (edges[seed, 2] - edges[seed, 0]) * (edges[other, 2] - edges[other, 0]) + \
+                           (edges[seed, 3] - edges[seed, 1]) * (edges[other, 3] - edges[other, 1])
+                flipped[other] = dot_prod < 0
+        n_groups += 1
+
+    return group, flipped, n_groups
+
+
+@njit(nogil=True, fastmath=FASTMATH, cache=CACHE)
+def _super_edges(edges, group, flipped, n_groups):
+    ## Mean of the aligned endpoints of every group
+    coarse = np.zeros((n_groups, 4), dtype=np.float64)
+    counts = np.zeros(n_groups, dtype=np.int64)
+    for i in range(edges.shape[0]):
+        g = group[i]
+        if flipped[i]:
+            coarse[g, 0] += edges[i, 2]
+            coarse[g, 1] += edges[i, 3]
+            coarse[g, 2] += edges[i, 0]
+            coarse[g, 3] += edges[i, 1]
+        else:
+            coarse[g, :] += edges[i, :]
+        counts[g] += 1
+
+    for g in range(n_groups):
+        coarse[g, :] /= counts[g]
+    return coarse
+
+
+@njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=CACHE)
+def project_points(edges, coarse_edges, coarse_points, group, flipped):
+    ## Polyline of every edge from the polyline of its super-edge, with the endpoint offsets
+    ## blended in linearly so it starts and ends on the edge's own endpoints
+    E = edges.shape[0]
+    n_points = coarse_points.shape[1]
+    points = np.empty((E, n_points, 2), dtype=np.float64)
+    for edge_idx in prange(E):
+        g = group[edge_idx]
+        if flipped[edge_idx]:
+            sx, sy, tx, ty = edges[edge_idx, 2], edges[edge_idx, 3], edges[edge_idx, 0], edges[edge_idx, 1]
+        else:
+            sx, sy, tx, ty = edges[edge_idx, 0], edges[edge_idx, 1], edges[edge_idx, 2], edges[edge_idx, 3]
+        ds_x, ds_y = sx - coarse_edges[g, 0], sy - coarse_edges[g, 1]
+        dt_x, dt_y = tx - coarse_edges[g, 2], ty - coarse_edges[g, 3]
+
+        for k in range(n_points):
+            t = k / (n_points - 1)
+            out = n_points - 1 - k if flipped[edge_idx] else k
+            points[edge_idx, out, 0] = coarse_points[g, k, 0] + (1 - t) * ds_x + t * dt_x
+            points[edge_idx, out, 1] = coarse_points[g, k, 1] + (1 - t) * ds_y + t * dt_y
+
+    return points
+
+
+def final_parameters(config):
+    ## S and P of the forcebundle result, after the last cycle
+    S = config.S_initial
+    P = config.P_initial
+    for _cycle in range(config.C):
+        S *= config.S_rate
+        P = round(P * config.P_rate)
+    return S, P
+
+
+def refine(edges, points, compatibility, iterations=None, cancel=None, config=None):
+    ## A few jacobi iterations at the final cycle parameters
+    iterations = REFINE_ITERATIONS if iterations is None else iterations
+    config = BundlingConfig() if config is None else config
+    S, P = final_parameters(config)
+    indptr, row_end, indices, scores = compatibility.arrays()
+    new_points = np.empty_like(points)
+    moves = np.zeros((edges.shape[0], 3), dtype=np.float64)
+    forces = np.empty((edges.shape[0], P, 2), dtype=np.float64)
+    for _iteration in range(iterations):
+        array_bundling.jacobi_iteration(edges, points, new_points, indptr, row_end, indices, scores, config.K, P,
+                                        S, config.eps, moves, forces)
+        points, new_points = new_points, points
+        if cancel is not None and cancel.is_set():
+            raise BundlingCancelled()
+    return points
+
+
+def multilevel_forcebundle(edges, compatibility=None, threads=None, threshold=None, coarse_edges=None,
+                           refine_iterations=None, cancel=None, config=None):
+    ## Same result layout as array_bundling.forcebundle, (E, P+2, 2) subdivision points
+    threshold = COARSEN_THRESHOLD if threshold is None else threshold
+    coarse_edges = COARSE_EDGES if coarse_edges is None else coarse_edges
+    config = BundlingConfig() if config is None else config
+
+    old_threads = get_num_threads()
+    if threads is not None:
+        set_num_threads(threads)
+
+    try:
+        if compatibility is None:
+            print("Compute compatibilities:")
+            compatibility = compute_compatible_list(edges, cancel=cancel, config=config)
+
+        ##Coarsen
+        levels = []  # (edges, compatibility, group, flipped) of every finer level
+        level_edges, level_compatibility = edges, compatibility
+        while level_edges.shape[0] > coarse_edges:
+            group, flipped, n_groups = _group_edges(level_edges, *level_compatibility.arrays(), threshold)
+            if n_groups > MIN_REDUCTION * level_edges.shape[0]:
+                break
+            print("Level {}: {} -> {} edges".format(len(levels) + 1, level_edges.shape[0], n_groups))
+            levels.append((level_edges, level_compatibility, group, flipped))
+            level_edges = _super_edges(level_edges, group, flipped, n_groups)
+            level_compatibility = compute_compatible_list(level_edges, cancel=cancel, config=config)
+
+        ##Bundle the coarsest level
+        points = array_bundling.forcebundle(level_edges, mode="jacobi", compatibility=level_compatibility,
+                                            cancel=cancel, config=config)
+
+        ##Project and refine
+        for fine_edges, fine_compatibility, group, flipped in reversed(levels):
+            points = project_points(fine_edges, level_edges, points, group, flipped)
+            points = refine(fine_edges, points, fine_compatibility, refine_iterations, cancel, config)
+            level_edges = fine_edges
+
+        return points
+    finally:
+        set_num_threads(old_threads)
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import itertools
+import os
+import sys
+import time
+import numpy as np
+
+from bundling_config import BundlingConfig
+from compatibility import COMPATIBILITY_FLOOR
+import bundling_cache
+import route_merging
+
+## Parameter sweeps: bundle one graph with many BundlingConfigs in a pool of processes.
+## The compatibility matrix is computed once by the caller's process and stored in the bundling
+## cache, every worker maps the same files read-only, so the matrix is shared instead of copied.
+## Configs with different compatibility thresholds above COMPATIBILITY_FLOOR share one matrix.
+## Results go through the bundling cache as well, a repeated sweep only bundles new configs.
+
+_worker_edges = None
+
+
+def _init_worker(edges, threads):
+    global _worker_edges
+    _worker_edges = edges
+    if threads is not None:
+        from numba import set_num_threads
+        set_num_threads(threads)
+
+
+def _bundle(config, cache_dir, mode, tolerance, merge):
+    start = time.time()
+    points = bundling_cache.cached_forcebundle(_worker_edges, mode=mode, cache_dir=cache_dir, tolerance=tolerance,
+                                               config=config, merge=merge)
+    return np.asarray(points), time.time() - start
+
+
+def sweep(edges, configs, processes=None, cache_dir=None, mode=None, tolerance=None, merge=None):
+    ## Yields (config, points, seconds) in the order of configs.
+    ## The cores are split between the processes (processes=None -> 4 or fewer)
+    configs = list(configs)
+    if not configs:
+        return
+    merge = route_merging.MERGE_ROUTES if merge is None else merge
+
+    ## Compute (or find) the shared matrices before starting the workers
+    bundle_edges = route_merging.merge_routes(edges).edges if merge else edges
+    for floor, eps, min_length in {(min(COMPATIBILITY_FLOOR, config.compatibility_threshold), config.eps,
+                                    config.min_length) for config in configs}:
+        bundling_cache.cached_compatible_list(bundle_edges, cache_dir,
+                                              config=BundlingConfig(compatibility_threshold=floor, eps=eps,
+                                                                    min_length=min_length))
+
+    cpus = os.cpu_count() or 1
+    processes = min(len(configs), 4, cpus) if processes is None else processes
+    threads = max(1, cpus // processes)
+
+    ## spawn, the threading layer of the parent's numba kernels is not fork safe
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(edges, threads)) as pool:
+        futures = [pool.submit(_bundle, config, cache_dir, mode, tolerance, merge) for config in configs]
+        for config, future in zip(configs, futures):
+            points, seconds = future.result()
+            yield config, points, seconds
+
+
+def main():
+    ## Example sweep over the spring constant and the step size on airlines:
+    ##   python sweep.py [processes]
+    import graph
+    from array_bundling import convert_edges
+
+    g = graph.graph()
+    g.parse("airlines.graphml/airlines.graphml")
+    edges = convert_edges(g)
+
+    configs = [BundlingConfig(K=K, S_initial=S) for K, S in itertools.product((5, 10, 20), (0.2, 0.4))]
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    start = time.time()
+    for config, points, seconds in sweep(edges, configs, processes):
+        ## Mean distance of the inner points from their straight line position
+        straight = np.linspace(edges[:, :2], edges[:, 2:], points.shape[1], axis=1)
+        offset = np.linalg.norm(points - straight, axis=2)[:, 1:-1].mean()
+        print("K={:<4} S_initial={:<5} {:6.2f}s  mean offset {:.2f}".format(config.K, config.S_initial, seconds,
+                                                                          offset))
+    print("Sweep done in {:.2f}s".format(time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+## Checks the array engine against the Point/Edge engine (edge_bundling) on airlines:
+##   compute_compatible_list: same neighbours and scores as edge_bundling, grid equal to tiles
+##   CompatibilityMatrix.above: same rows as a recompute at that threshold
+##   update_edge_divisions: same resampled points as edge_bundling
+## edge_bundling keeps coordinates as float32, so the endpoints are rounded to float32 for both engines
+## and scores and points are compared within float32 precision.
+##
+##   python test/compare_engines.py
+import os
+import sys
+
+import numpy as np
+from numba import float32
+from numba.typed import List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import edge_bundling
+import array_bundling
+from bundling_config import BundlingConfig, compatibility_threshold
+from compatibility import compute_compatible_list
+from graphml_loader import load_graphml
+
+GRAPH = os.path.join(os.path.dirname(HERE), "airlines.graphml", "airlines.graphml")
+
+
+def load_edges(path):
+    arrays = load_graphml(path)
+    edges = arrays.xy[arrays.edge_index].reshape(-1, 4)
+    return edges.astype(np.float32).astype(np.float64)
+
+
+def point_edges(edges):
+    point_edges = edge_bundling.get_empty_edge_list()
+    for edge_idx, (sx, sy, tx, ty) in enumerate(edges):
+        point_edges.append(edge_bundling.Edge(edge_bundling.Point(float32(sx), float32(sy)),
+                                              edge_bundling.Point(float32(tx), float32(ty)), edge_idx))
+    return point_edges
+
+
+def rows(compatibility):
+    return [dict(zip(*map(np.ndarray.tolist, compatibility.neighbours(edge_idx))))
+            for edge_idx in range(len(compatibility))]
+
+
+def check_compatibility(edges, old_edges):
+    print("edge_bundling.compute_compatible_list:")
+    old_lists, old_scores = edge_bundling.compute_compatible_list(old_edges)
+    grid = compute_compatible_list(edges, method="grid")
+    tiles = compute_compatible_list(edges, method="tiles")
+
+    for name in ("indptr", "indices", "scores"):
+        assert np.array_equal(getattr(grid, name), getattr(tiles, name)), "grid and tiles differ in " + name
+    print("grid == tiles: {} pairs".format(grid.nnz // 2))
+
+    ## Pairs on the threshold can fall either way between float32 and float64 scores
+    missing = extra = 0
+    worst = 0.0
+    for edge_idx, new in enumerate(rows(grid)):
+        old = dict(zip(old_lists[edge_idx], old_scores[edge_idx]))
+        for other in old.keys() ^ new.keys():
+            score = old.get(other, new.get(other))
+            assert abs(score - compatibility_threshold) < 1e-5, (edge_idx, other, score)
+            missing += other in old
+            extra += other in new
+        for other in old.keys() & new.keys():
+            worst = max(worst, abs(old[other] - new[other]))
+    print("neighbours: {} missing, {} extra (all on the threshold), largest score difference {:.2e}".format(
+        missing, extra, worst))
+    assert worst < 1e-5
+    return grid
+
+
+def check_above(edges):
+    full = compute_compatible_list(edges, floor=0.1)
+    for threshold in (0.2, 0.3, 0.5, 0.8):
+        view = full.above(threshold)
+        recompute = compute_compatible_list(edges, config=BundlingConfig(compatibility_threshold=threshold))
+        assert view.nnz == recompute.nnz, threshold
+        for edge_idx in range(len(view)):
+            view_indices, view_scores = view.neighbours(edge_idx)
+            indices, scores = recompute.neighbours(edge_idx)
+            assert np.array_equal(view_indices, indices) and np.array_equal(view_scores, scores), \
+                (threshold, edge_idx)
+        print("above({}) == recompute: {} pairs".format(threshold, view.nnz // 2))
+
+
+def check_resampling(edges, old_edges):
+    ## Randomly bent polylines with the point counts of the cycles, resampled by both engines
+    rng = np.random.default_rng(0)
+    scale = np.abs(edges).max()
+    for P, new_P in ((1, 2), (2, 4), (4, 7), (7, 12), (12, 21)):
+        points = array_bundling.create_edge_subdivision(edges, P)
+        points[:, 1:-1] += rng.normal(0.0, 0.02 * scale, points[:, 1:-1].shape)
+        points = points.astype(np.float32).astype(np.float64)
+        old_points = List()
+        for edge_points in points:
+            old_points.append(List([edge_bundling.Point(float32(x), float32(y)) for x, y in edge_points]))
+
+        points = array_bundling.update_edge_divisions(edges, points, new_P)
+        old_points = edge_bundling.update_edge_divisions(old_edges, old_points, new_P)
+
+        ## The last segment ends on the target. Rounding decides whether edge_bundling emits a point there,
+        ## so it gives one point less or one more (on the target) for many edges. array_bundling always
+        ## has new_P inner points, the one on the target is compared to the target for the shorter edges
+        worst = 0.0
+        counts = {-1: 0, 0: 0, 1: 0}
+        for edge_idx, edge_points in enumerate(old_points):
+            old = np.array([(point.x, point.y) for point in edge_points], dtype=np.float64)
+            new = points[edge_idx]
+            extra = old.shape[0] - new.shape[0]
+            assert extra in counts, (edge_idx, old.shape[0], new_P + 2)
+            counts[extra] += 1
+            if extra == -1:
+                old = np.insert(old, new_P, old[-1], axis=0)
+            elif extra == 1:
+                assert np.abs(old[new_P + 1] - old[-1]).max() < 1e-5 * scale, edge_idx
+                old = np.delete(old, new_P + 1, axis=0)
+            worst = max(worst, np.abs(old - new).max())
+        print("P {} -> {}: largest point difference {:.2e} ({:.1e} of the extent), edge_bundling has a point "
+              "less on {} and one more on {} edges".format(P, new_P, worst, worst / scale, counts[-1], counts[1]))
+        assert worst < 1e-5 * scale
+
+
+if __name__ == "__main__":
+    edges = load_edges(sys.argv[1] if len(sys.argv) > 1 else GRAPH)
+    old_edges = point_edges(edges)
+    print("{} edges".format(edges.shape[0]))
+    check_compatibility(edges, old_edges)
+    check_above(edges)
+    check_resampling(edges, old_edges)
+    print("All checks passed")